@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 import sys
 import json
+import copy
+import zlib
 import socket
+import struct
+import queue
+import threading
 import webbrowser
 import ctypes
 from pathlib import Path
@@ -13,7 +18,17 @@ from PyQt5.QtWidgets import (
     QSplitter
 )
 from PyQt5.QtCore import Qt, QSize, QThread, pyqtSignal
-from PyQt5.QtGui import QIcon, QFont, QPixmap, QPainter, QColor
+from PyQt5.QtGui import QIcon, QFont, QPixmap, QPainter, QColor, QTextCursor
+
+# Líneas que se piden al abrir un log (después solo se piden las nuevas)
+LOG_TAIL_LINES = 500
+
+# Protocolo con tramas del servidor: 'PRCB' + versión + flags + longitud (big endian) + JSON
+FRAME_MAGIC = b'PRCB'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('>4sBBI')
+FRAME_ZLIB = 0x01  # flag: JSON comprimido con zlib (solo si el servidor lo acepta en el saludo)
+FRAME_COMPRESS_MIN = 1024  # las peticiones más pequeñas se envían sin comprimir
 
 # --- HILO PARA ESCUCHAR LA SEGUNDA INSTANCIA ---
 class InstanceListener(QThread):
@@ -33,6 +48,25 @@ class InstanceListener(QThread):
         except:
             pass
 
+# --- HILO PARA SEGUIR LOS LOGS EN VIVO ---
+class LogFollower(QThread):
+    line_received = pyqtSignal(str, str)
+    lines_lost = pyqtSignal(int)
+    follow_error = pyqtSignal(str)
+
+    def __init__(self, client, log_types):
+        super().__init__()
+        self.client = client
+        self.log_types = log_types
+
+    def run(self):
+        try:
+            for message in self.client.follow_logs(self.log_types, self.isInterruptionRequested):
+                if 'perdidas' in message: self.lines_lost.emit(message['perdidas'])
+                else: self.line_received.emit(message['log_type'], message['linea'])
+        except Exception as e:
+            if not self.isInterruptionRequested(): self.follow_error.emit(str(e))
+
 class NoWheelSpinBox(QSpinBox):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -40,34 +74,164 @@ class NoWheelSpinBox(QSpinBox):
         event.ignore()
 
 class PercebeClient:
-    def __init__(self, server_ip, server_port=5555):
+    """
+    Cliente de la API. Mantiene una conexión persistente con tramas y la reutiliza
+    entre comandos; con servidores antiguos (sin tramas) usa una conexión por comando.
+    Es bloqueante: desde la interfaz se usa a través de ApiWorker.
+    """
+    def __init__(self, server_ip, server_port=5555, timeout=30):
         self.server_ip = server_ip
         self.server_port = server_port
-    
+        self.timeout = timeout
+        self._socket = None
+        self._framed = None  # None = aún no se sabe si el servidor usa tramas
+        self._compress = False  # el servidor acepta tramas comprimidas
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock: self._close()
+
+    def _close(self):
+        if self._socket:
+            try: self._socket.close()
+            except OSError: pass
+            self._socket = None
+
+    def _connect(self):
+        self._socket = socket.create_connection((self.server_ip, self.server_port), timeout=self.timeout)
+        if self._framed is False: return
+        # Saludo: un servidor antiguo no entiende la trama y responde un JSON de error
+        self._compress = False
+        self._send_frame({'command': 'hello', 'version': FRAME_VERSION, 'compresion': ['zlib']})
+        start = self._recv_exactly(len(FRAME_MAGIC), allow_short=True)
+        if start != FRAME_MAGIC:
+            self._framed = False
+            self._close()
+            self._socket = socket.create_connection((self.server_ip, self.server_port), timeout=self.timeout)
+            return
+        self._framed = True
+        self._compress = self._read_frame(start).get('compresion') == 'zlib'
+
+    def _recv_exactly(self, size, allow_short=False):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(min(size - len(data), 1 << 20))
+            if not chunk:
+                if allow_short: break
+                raise ConnectionError('Conexión cerrada por el servidor')
+            data += chunk
+        return bytes(data)
+
+    def _send_frame(self, message):
+        body, flags = json.dumps(message).encode('utf-8'), 0
+        if self._compress and len(body) >= FRAME_COMPRESS_MIN:
+            compressed = zlib.compress(body, 6)
+            if len(compressed) < len(body): body, flags = compressed, FRAME_ZLIB
+        self._socket.sendall(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, len(body)) + body)
+
+    def _read_frame(self, start=b''):
+        magic, version, flags, length = FRAME_HEADER.unpack(start + self._recv_exactly(FRAME_HEADER.size - len(start)))
+        if magic != FRAME_MAGIC: raise ConnectionError('Respuesta no válida del servidor')
+        body = self._recv_exactly(length)
+        if flags & FRAME_ZLIB: body = zlib.decompress(body)
+        return json.loads(body.decode('utf-8'))
+
+    def _legacy_exchange(self, command_data):
+        # Protocolo antiguo: el servidor cierra la conexión al terminar la respuesta
+        self._socket.sendall(json.dumps(command_data).encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = self._socket.recv(65536)
+            if not chunk: break
+            chunks.append(chunk)
+        self._close()
+        return json.loads(b''.join(chunks).decode('utf-8'))
+
     def send_command(self, command_data):
+        with self._lock:
+            for attempt in range(2):
+                reused = self._socket is not None
+                try:
+                    if not reused: self._connect()
+                    if not self._framed: return self._legacy_exchange(command_data)
+                    self._next_id += 1
+                    self._send_frame({**command_data, 'id': self._next_id})
+                    while True:
+                        response = self._read_frame()
+                        if response.get('id', self._next_id) == self._next_id: return response
+                except Exception as e:
+                    self._close()
+                    # La conexión persistente puede haber caducado: se reintenta una vez con una nueva
+                    if attempt or not reused:
+                        return {'status': 'error', 'message': f'Error de conexión: {str(e)}'}
+
+    def get_config(self, etag=None): return self.send_command({'command': 'get_config', 'etag': etag})
+    def set_config(self, config): return self.send_command({'command': 'set_config', 'config': config})
+    def patch_config(self, cambios, etag=None): return self.send_command({'command': 'patch_config', 'cambios': cambios, 'etag': etag})
+    def get_logs(self, log_type='reenvios', **opciones): return self.send_command({'command': 'get_logs', 'log_type': log_type, **opciones})
+    def get_imap_sessions(self): return self.send_command({'command': 'get_imap_sessions'})
+    def get_send_rates(self): return self.send_command({'command': 'get_send_rates'})
+    def get_metrics(self): return self.send_command({'command': 'get_metrics'})
+    def start_trace(self, **opciones): return self.send_command({'command': 'start_trace', **opciones})
+    def stop_trace(self): return self.send_command({'command': 'stop_trace'})
+    def get_trace(self): return self.send_command({'command': 'get_trace'})
+
+    def download_trace(self, path):
+        """Guarda la última traza del servidor como JSON (se abre en chrome://tracing, Perfetto o speedscope)"""
+        result = self.get_trace()
+        if result.get('status') == 'ok':
+            with open(path, 'w', encoding='utf-8') as f: json.dump(result['data'], f)
+        return result
+    def query_events(self, **filtros): return self.send_command({'command': 'query_events', **filtros})
+
+    def follow_logs(self, log_types=None, should_stop=lambda: False):
+        """Generador con las líneas de log que el servidor va escribiendo ({'log_type', 'linea'} o {'perdidas'})"""
+        client_socket = socket.create_connection((self.server_ip, self.server_port), timeout=5)
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.settimeout(5)
-            client_socket.connect((self.server_ip, self.server_port))
-            request = json.dumps(command_data).encode('utf-8')
-            client_socket.send(request)
-            response = b''
-            while True:
-                chunk = client_socket.recv(4096)
+            client_socket.sendall(json.dumps({'command': 'follow_logs', 'log_types': log_types}).encode('utf-8'))
+            client_socket.settimeout(1)
+            buffer, silence = b'', 0
+            while not should_stop():
+                try: chunk = client_socket.recv(65536)
+                except socket.timeout:
+                    # El servidor manda un latido cada 15 s: sin nada en 45 s la conexión está muerta
+                    silence += 1
+                    if silence > 45: raise ConnectionError('El servidor no responde')
+                    continue
                 if not chunk: break
-                response += chunk
-                try:
-                    json.loads(response.decode('utf-8'))
-                    break
-                except: continue
+                silence = 0
+                *lines, buffer = (buffer + chunk).split(b'\n')
+                for line in lines:
+                    if not line: continue
+                    message = json.loads(line.decode('utf-8'))
+                    if message.get('status') == 'error': raise ConnectionError(message.get('message'))
+                    if 'linea' in message or 'perdidas' in message: yield message
+        finally:
             client_socket.close()
-            return json.loads(response.decode('utf-8'))
-        except Exception as e:
-            return {'status': 'error', 'message': f'Error de conexión: {str(e)}'}
 
-    def get_config(self): return self.send_command({'command': 'get_config'})
-    def set_config(self, config): return self.send_command({'command': 'set_config', 'config': config})
-    def get_logs(self, log_type='reenvios'): return self.send_command({'command': 'get_logs', 'log_type': log_type})
+# --- HILO PARA LAS LLAMADAS A LA API (la interfaz nunca espera a la red) ---
+class ApiWorker(QThread):
+    response_ready = pyqtSignal(int, object)
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.requests = queue.Queue()
+
+    def submit(self, request_id, command_data):
+        self.requests.put((request_id, command_data))
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None: break
+            request_id, command_data = request
+            self.response_ready.emit(request_id, self.client.send_command(command_data))
+        self.client.close()
+
+    def stop(self):
+        self.requests.put(None)
 
 class MainWindow(QMainWindow):
     def __init__(self, icon_path=None):
@@ -77,7 +241,16 @@ class MainWindow(QMainWindow):
         self.client_config = self.load_client_config()
         self.client = None
         self.server_config = None
+        self.server_key = None  # (ip, puerto) del servidor conectado
+        self.config_etag = None  # versión de la configuración en la que se basa server_config
+        self.config_cache = {}  # (ip, puerto) -> (etag, configuración tal como la tiene el servidor)
         self.current_account_index = None
+        self.log_cursors = {}  # tipo de log -> byte hasta el que ya se ha mostrado
+        self.log_follower = None
+        self.api_worker = None
+        self.retired_workers = set()  # hilos de la API parados que aún no han terminado
+        self.api_callbacks = {}  # id de petición -> función que recibe la respuesta
+        self.api_request_id = 0
         
         if self.icon_path and Path(self.icon_path).exists():
             self.setWindowIcon(QIcon(self.icon_path))
@@ -229,6 +402,8 @@ class MainWindow(QMainWindow):
         self.account_active_check = QCheckBox("Cuenta activa")
         self.account_active_check.setChecked(True)
         general_layout.addRow("Estado:", self.account_active_check)
+        self.account_idle_check = QCheckBox("Modo IDLE (aviso inmediato de correo nuevo)")
+        general_layout.addRow("Revisión:", self.account_idle_check)
         general_group.setLayout(general_layout)
         scroll_layout.addWidget(general_group)
         
@@ -344,7 +519,12 @@ class MainWindow(QMainWindow):
         layout = QVBoxLayout(tab)
         btn_refresh = QPushButton("🔄 Actualizar Logs")
         btn_refresh.clicked.connect(lambda: self.load_logs('reenvios'))
-        layout.addWidget(btn_refresh)
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(btn_refresh)
+        self.follow_logs_check = QCheckBox("📡 Seguir en vivo")
+        self.follow_logs_check.toggled.connect(self.toggle_log_follow)
+        buttons_layout.addWidget(self.follow_logs_check)
+        layout.addLayout(buttons_layout)
         self.logs_text = QTextEdit()
         self.logs_text.setReadOnly(True)
         self.logs_text.setFont(QFont("Consolas", 10))
@@ -395,29 +575,74 @@ class MainWindow(QMainWindow):
         self.hide()
 
     def exit_application(self):
+        self.stop_log_follow()
+        if self.api_worker: self.retire_api_worker(self.api_worker)
         self.tray_icon.hide()
         QApplication.quit()
 
     def activate_percebeiro_pro(self):
         webbrowser.open("https://shattereddisk.github.io/rickroll/rickroll.mp4")
 
+    def call_api(self, command_data, callback, worker=None):
+        """Envía un comando en segundo plano; `callback` recibe la respuesta en el hilo de la interfaz"""
+        self.api_request_id += 1
+        self.api_callbacks[self.api_request_id] = callback
+        (worker or self.api_worker).submit(self.api_request_id, command_data)
+
+    def create_api_worker(self, client):
+        worker = ApiWorker(client)
+        worker.response_ready.connect(self.on_api_response)
+        worker.start()
+        return worker
+
+    def retire_api_worker(self, worker):
+        # Un QThread no puede destruirse con su hilo en marcha: se guarda hasta que termina
+        self.retired_workers.add(worker)
+        worker.finished.connect(lambda: self.release_api_worker(worker))
+        worker.stop()
+
+    def release_api_worker(self, worker):
+        worker.wait()
+        self.retired_workers.discard(worker)
+
+    def on_api_response(self, request_id, result):
+        callback = self.api_callbacks.pop(request_id, None)
+        if callback: callback(result)
+
     def test_server_connection(self):
         ip = self.ip_input.text().strip()
         port = self.port_input.value()
-        test_client = PercebeClient(ip, port)
-        result = test_client.get_config()
-        if result.get('status') == 'ok':
-            QMessageBox.information(self, "Éxito", "✓ Conexión establecida correctamente.")
-        else:
-            QMessageBox.warning(self, "Error", f"Fallo: {result.get('message')}")
+        test_worker = self.create_api_worker(PercebeClient(ip, port))
+        def on_result(result):
+            self.retire_api_worker(test_worker)
+            if result.get('status') == 'ok':
+                QMessageBox.information(self, "Éxito", "✓ Conexión establecida correctamente.")
+            else:
+                QMessageBox.warning(self, "Error", f"Fallo: {result.get('message')}")
+        # get_config lo entienden todas las versiones del servidor (hello solo las que usan tramas)
+        self.call_api({'command': 'get_config'}, on_result, test_worker)
 
     def connect_to_server(self):
         ip = self.ip_input.text().strip()
         port = self.port_input.value()
+        self.follow_logs_check.setChecked(False)
+        if self.api_worker: self.retire_api_worker(self.api_worker)
         self.client = PercebeClient(ip, port)
-        result = self.client.get_config()
-        if result.get('status') == 'ok':
-            self.server_config = result.get('data', {})
+        self.api_worker = self.create_api_worker(self.client)
+        self.log_cursors = {}
+        # Si ya se tiene una copia, el servidor solo manda la configuración cuando ha cambiado
+        cached = self.config_cache.get((ip, port))
+        request = {'command': 'get_config', 'etag': cached[0] if cached else None}
+        self.call_api(request, lambda result: self.on_server_config(result, ip, port))
+
+    def on_server_config(self, result, ip, port):
+        cached = self.config_cache.get((ip, port))
+        if result.get('status') == 'ok' and (cached or not result.get('no_modificado')):
+            config = cached[1] if result.get('no_modificado') else result.get('data', {})
+            self.server_key = (ip, port)
+            self.config_etag = result.get('etag')
+            self.config_cache[self.server_key] = (self.config_etag, config)
+            self.server_config = copy.deepcopy(config)
             self.client_config['server_ip'] = ip
             self.client_config['server_port'] = port
             self.save_client_config()
@@ -447,6 +672,7 @@ class MainWindow(QMainWindow):
     def load_account_data(self, cuenta):
         self.account_name_input.setText(cuenta.get('nombre', ''))
         self.account_active_check.setChecked(cuenta.get('activa', True))
+        self.account_idle_check.setChecked(cuenta.get('modo_idle', False))
         self.imap_server_input.setText(cuenta.get('imap_server', ''))
         self.imap_user_input.setText(cuenta.get('imap_user', ''))
         self.imap_password_input.setText(cuenta.get('imap_password', ''))
@@ -477,7 +703,7 @@ class MainWindow(QMainWindow):
 
     def create_new_account(self):
         nueva_cuenta = {
-            'nombre': 'Nueva Cuenta', 'activa': True,
+            'nombre': 'Nueva Cuenta', 'activa': True, 'modo_idle': False,
             'imap_server': '', 'imap_user': '', 'imap_password': '',
             'smtp_server': '', 'smtp_port': 587, 'smtp_user': '', 'smtp_password': '',
             'reglas': []
@@ -507,6 +733,7 @@ class MainWindow(QMainWindow):
         cuenta = self.server_config['cuentas'][self.current_account_index]
         cuenta['nombre'] = self.account_name_input.text()
         cuenta['activa'] = self.account_active_check.isChecked()
+        cuenta['modo_idle'] = self.account_idle_check.isChecked()
         cuenta['imap_server'] = self.imap_server_input.text()
         cuenta['imap_user'] = self.imap_user_input.text()
         cuenta['imap_password'] = self.imap_password_input.text()
@@ -528,20 +755,83 @@ class MainWindow(QMainWindow):
             regla['palabras_clave'] = [s.strip() for s in self.rule_keywords_text.toPlainText().split('\n') if s.strip()]
             regla['destinatarios'] = [s.strip() for s in self.rule_recipients_text.toPlainText().split('\n') if s.strip()]
             
-        # 3. Enviar todo el objeto server_config al servidor
-        result = self.client.set_config(self.server_config)
+        # 3. Servidor antiguo (sin versiones): enviar todo el objeto server_config
+        if self.config_etag is None:
+            self.call_api({'command': 'set_config', 'config': self.server_config}, self.on_config_saved)
+            return
+        
+        # 4. Enviar solo las cuentas nuevas o modificadas respecto a la copia del servidor
+        base = self.config_cache[self.server_key][1].get('cuentas', [])
+        cambios = []
+        for i, cuenta in enumerate(self.server_config.get('cuentas', [])):
+            if i >= len(base): cambios.append({'op': 'add', 'ruta': ['cuentas'], 'valor': cuenta})
+            elif cuenta != base[i]: cambios.append({'op': 'set', 'ruta': ['cuentas', i], 'valor': cuenta})
+        if not cambios:
+            self.on_config_saved({'status': 'ok'})
+            return
+        snapshot = copy.deepcopy(self.server_config)
+        request = {'command': 'patch_config', 'etag': self.config_etag, 'cambios': cambios}
+        self.call_api(request, lambda result: self.on_config_saved(result, snapshot))
+
+    def on_config_saved(self, result, snapshot=None):
         if result.get('status') == 'ok':
+            if snapshot is not None and result.get('etag'):
+                self.config_etag = result['etag']
+                self.config_cache[self.server_key] = (self.config_etag, snapshot)
             QMessageBox.information(self, "Éxito", "Configuración guardada correctamente en el servidor.")
             self.load_rules() # Refrescar lista de reglas (por si cambió el nombre o estado)
+        elif result.get('conflicto'):
+            QMessageBox.warning(self, "Aviso", "La configuración ha cambiado en el servidor. Se va a recargar; vuelve a aplicar tus cambios.")
+            ip, port = self.server_key
+            self.call_api({'command': 'get_config', 'etag': self.config_etag}, lambda result: self.on_server_config(result, ip, port))
         else:
             QMessageBox.warning(self, "Error", f"No se pudo guardar: {result.get('message')}")
 
     def load_logs(self, log_type):
-        result = self.client.get_logs(log_type)
+        # Primera carga: últimas líneas; después solo lo añadido desde el último cursor
+        if not self.api_worker: return
+        cursor = self.log_cursors.get(log_type)
+        if cursor is None: request = {'command': 'get_logs', 'log_type': log_type, 'tail': LOG_TAIL_LINES}
+        else: request = {'command': 'get_logs', 'log_type': log_type, 'desde_byte': cursor}
+        self.call_api(request, lambda result: self.on_logs_loaded(log_type, cursor, result))
+
+    def on_logs_loaded(self, log_type, cursor, result):
+        text_widget = self.logs_text if log_type == 'reenvios' else self.errors_text
         if result.get('status') == 'ok':
             content = "".join(result.get('data', []))
-            if log_type == 'reenvios': self.logs_text.setPlainText(content)
-            else: self.errors_text.setPlainText(content)
+            if cursor is None or result.get('reiniciado'): text_widget.setPlainText(content)
+            elif content:
+                text_widget.moveCursor(QTextCursor.End)
+                text_widget.insertPlainText(content)
+            self.log_cursors[log_type] = result.get('cursor')
+
+    def toggle_log_follow(self, enabled):
+        if not enabled: return self.stop_log_follow()
+        if not self.client:
+            self.follow_logs_check.setChecked(False)
+            return
+        self.log_follower = LogFollower(self.client, ['reenvios', 'errores'])
+        self.log_follower.line_received.connect(self.append_followed_line)
+        self.log_follower.lines_lost.connect(lambda n: self.logs_text.append(f"... {n} líneas omitidas (cliente demasiado lento) ..."))
+        self.log_follower.follow_error.connect(self.on_log_follow_error)
+        self.log_follower.start()
+
+    def stop_log_follow(self):
+        if self.log_follower:
+            self.log_follower.requestInterruption()
+            self.log_follower.wait(2000)
+            self.log_follower = None
+
+    def append_followed_line(self, log_type, line):
+        text_widget = self.logs_text if log_type == 'reenvios' else self.errors_text
+        text_widget.moveCursor(QTextCursor.End)
+        text_widget.insertPlainText(line)
+        # El cursor incremental ya no coincide con lo mostrado: el próximo refresco recarga el final
+        self.log_cursors.pop(log_type, None)
+
+    def on_log_follow_error(self, message):
+        self.follow_logs_check.setChecked(False)
+        QMessageBox.warning(self, "Error", f"Seguimiento de logs interrumpido: {message}")
 
     def apply_styles(self):
         style = """
@@ -7,52 +7,1774 @@ Versión 2.1 - Con sistema de reintentos y cola persistente
 
 import json
 import os
+import sys
+import signal
+import gzip
+import zlib
+import shutil
 import imaplib
 import smtplib
 import email
 import socket
+import struct
+import asyncio
 import threading
 import time
 import random
 import string
+import sqlite3
+import base64
+import hashlib
+import heapq
+import queue
+import bisect
+import functools
+import io
+import cProfile
+import pstats
+import tracemalloc
+from collections import deque
+import re
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.header import decode_header
 from email.utils import formatdate
 from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
 from email.mime.base import MIMEBase
 from email import encoders
+from email import policy as email_policy
+from email.feedparser import BytesFeedParser
+
+
+# Protocolo de la API con tramas: 'PRCB' + versión + flags + longitud (big endian) + JSON.
+# Las conexiones que no empiezan por la marca se atienden con el protocolo antiguo
+# (un JSON por conexión, sin tramas).
+TRAMA_MAGIA = b'PRCB'
+TRAMA_VERSION = 1
+TRAMA_CABECERA = struct.Struct('>4sBBI')
+TRAMA_MAX = 64 * 1024 * 1024
+TRAMA_ZLIB = 0x01  # flag: el JSON va comprimido con zlib (solo si se ha negociado en hello)
+
+
+class TramaInvalidaError(Exception):
+    """Trama de la API mal formada, de otra versión o demasiado grande"""
+
+
+def encode_frame(mensaje, flags=0, comprimir_desde=0):
+    """Serializa un mensaje como trama del protocolo de la API.
+
+    Con `comprimir_desde` > 0, los cuerpos de ese tamaño o más se comprimen con
+    zlib (si así ocupan menos) y se marca TRAMA_ZLIB en los flags.
+    """
+    cuerpo = json.dumps(mensaje, ensure_ascii=False).encode('utf-8')
+    if comprimir_desde and len(cuerpo) >= comprimir_desde:
+        comprimido = zlib.compress(cuerpo, 6)
+        if len(comprimido) < len(cuerpo):
+            cuerpo, flags = comprimido, flags | TRAMA_ZLIB
+    return TRAMA_CABECERA.pack(TRAMA_MAGIA, TRAMA_VERSION, flags, len(cuerpo)) + cuerpo
+
+
+async def read_frame(reader, inicio=b''):
+    """Lee una trama completa (`inicio`: bytes de la cabecera ya leídos). Devuelve (mensaje, flags)"""
+    cabecera = inicio + await reader.readexactly(TRAMA_CABECERA.size - len(inicio))
+    magia, version, flags, longitud = TRAMA_CABECERA.unpack(cabecera)
+    if magia != TRAMA_MAGIA:
+        raise TramaInvalidaError("Cabecera de trama no válida")
+    if version != TRAMA_VERSION:
+        raise TramaInvalidaError(f"Versión de protocolo no soportada: {version}")
+    if longitud > TRAMA_MAX:
+        raise TramaInvalidaError(f"Trama demasiado grande ({longitud} bytes)")
+    cuerpo = await reader.readexactly(longitud)
+    if flags & TRAMA_ZLIB:
+        # Se limita lo descomprimido para que una trama pequeña no pueda ocupar memoria sin límite
+        descompresor = zlib.decompressobj()
+        try:
+            cuerpo = descompresor.decompress(cuerpo, TRAMA_MAX)
+        except zlib.error as e:
+            raise TramaInvalidaError(f"Trama comprimida no válida: {e}")
+        if descompresor.unconsumed_tail:
+            raise TramaInvalidaError("Trama descomprimida demasiado grande")
+    return json.loads(cuerpo.decode('utf-8')), flags
+
+
+class SMTPConnectionPool:
+    """
+    Pool de sesiones SMTP autenticadas, agrupadas por cuenta (servidor, puerto, usuario).
+    Las sesiones se reutilizan entre destinatarios, reglas y ciclos; antes de
+    reutilizar una sesión se comprueba con NOOP y las inactivas se cierran.
+    """
+
+    def __init__(self, timeout_inactividad=300, timeout_conexion=30):
+        self.timeout_inactividad = timeout_inactividad
+        self.timeout_conexion = timeout_conexion
+        self._sesiones_libres = {}  # clave -> lista de (conexión, último uso)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pool_key(cuenta_config):
+        """Clave del pool para una cuenta"""
+        return (cuenta_config['smtp_server'], cuenta_config['smtp_port'], cuenta_config['smtp_user'])
+
+    def _connect(self, cuenta_config):
+        """Abre una sesión nueva: conexión, STARTTLS y login"""
+        server = smtplib.SMTP(cuenta_config['smtp_server'], cuenta_config['smtp_port'], timeout=self.timeout_conexion)
+        try:
+            server.starttls()
+            server.login(cuenta_config['smtp_user'], cuenta_config['smtp_password'])
+        except Exception:
+            self._close(server)
+            raise
+        return server
+
+    @staticmethod
+    def _close(server):
+        """Cierra una sesión ignorando errores (puede estar ya caída)"""
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def acquire(self, cuenta_config):
+        """Obtiene una sesión viva para la cuenta (reutilizada o nueva)"""
+        key = self.pool_key(cuenta_config)
+
+        while True:
+            with self._lock:
+                sesiones = self._sesiones_libres.get(key)
+                if not sesiones:
+                    break
+                server, ultimo_uso = sesiones.pop()
+
+            # Sesión caducada por inactividad: cerrarla y probar la siguiente
+            if time.time() - ultimo_uso > self.timeout_inactividad:
+                self._close(server)
+                continue
+
+            # Comprobar que la sesión sigue viva
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close(server)
+
+        return self._connect(cuenta_config)
+
+    def release(self, cuenta_config, server):
+        """Devuelve al pool una sesión que ha funcionado correctamente"""
+        key = self.pool_key(cuenta_config)
+        with self._lock:
+            self._sesiones_libres.setdefault(key, []).append((server, time.time()))
+
+    def discard(self, server):
+        """Descarta una sesión que ha fallado"""
+        self._close(server)
+
+    def close_idle(self):
+        """Cierra las sesiones que llevan más de timeout_inactividad sin usarse"""
+        limite = time.time() - self.timeout_inactividad
+        caducadas = []
+
+        with self._lock:
+            for key, sesiones in list(self._sesiones_libres.items()):
+                vivas = [(s, t) for s, t in sesiones if t >= limite]
+                caducadas.extend(s for s, t in sesiones if t < limite)
+                if vivas:
+                    self._sesiones_libres[key] = vivas
+                else:
+                    del self._sesiones_libres[key]
+
+        for server in caducadas:
+            self._close(server)
+        return len(caducadas)
+
+    def close_all(self):
+        """Cierra todas las sesiones del pool"""
+        with self._lock:
+            sesiones = [s for lista in self._sesiones_libres.values() for s, _ in lista]
+            self._sesiones_libres = {}
+
+        for server in sesiones:
+            self._close(server)
+
+
+class AhoCorasick:
+    """
+    Autómata de Aho-Corasick: localiza en una sola pasada por el texto todos los
+    patrones (subcadenas) que aparecen en él. Cada patrón lleva asociado un valor.
+    """
+
+    def __init__(self, patrones):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        self._siempre = set()  # valores de patrones vacíos (aparecen en cualquier texto)
+
+        for patron, valor in patrones:
+            if not patron:
+                self._siempre.add(valor)
+                continue
+            nodo = 0
+            for ch in patron:
+                siguiente = self._goto[nodo].get(ch)
+                if siguiente is None:
+                    siguiente = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                    self._goto[nodo][ch] = siguiente
+                nodo = siguiente
+            self._out[nodo].add(valor)
+
+        # Enlaces de fallo por anchura
+        cola = deque(self._goto[0].values())
+        while cola:
+            nodo = cola.popleft()
+            for ch, siguiente in self._goto[nodo].items():
+                cola.append(siguiente)
+                fallo = self._fail[nodo]
+                while fallo and ch not in self._goto[fallo]:
+                    fallo = self._fail[fallo]
+                self._fail[siguiente] = self._goto[fallo].get(ch, 0)
+                self._out[siguiente] |= self._out[self._fail[siguiente]]
+
+    def search(self, texto):
+        """Devuelve el conjunto de valores de los patrones presentes en el texto"""
+        goto, fail, out = self._goto, self._fail, self._out
+        encontrados = set(self._siempre)
+        nodo = 0
+
+        for ch in texto:
+            while nodo and ch not in goto[nodo]:
+                nodo = fail[nodo]
+            nodo = goto[nodo].get(ch, 0)
+            if out[nodo]:
+                encontrados |= out[nodo]
+
+        return encontrados
+
+
+class RuleIndex:
+    """
+    Reglas activas de una cuenta compiladas en dos autómatas (remitentes y palabras
+    clave del asunto). Una regla coincide si algún remitente y alguna palabra clave
+    aparecen como subcadena (sin distinguir mayúsculas); una lista vacía acepta
+    cualquier valor.
+    """
+
+    def __init__(self, reglas):
+        self.reglas = [r for r in reglas if r.get('activa', True)]
+        self._sin_remitentes = set()
+        self._sin_palabras = set()
+        patrones_remitentes = []
+        patrones_palabras = []
+
+        for i, regla in enumerate(self.reglas):
+            remitentes = regla.get('remitentes', [])
+            if remitentes:
+                patrones_remitentes.extend((rem.lower(), i) for rem in remitentes)
+            else:
+                self._sin_remitentes.add(i)
+
+            palabras = regla.get('palabras_clave', [])
+            if palabras:
+                patrones_palabras.extend((keyword.lower(), i) for keyword in palabras)
+            else:
+                self._sin_palabras.add(i)
+
+        self._remitentes = AhoCorasick(patrones_remitentes)
+        self._palabras = AhoCorasick(patrones_palabras)
+
+    def match(self, remitente, asunto):
+        """Devuelve, en el orden de la configuración, las reglas que coinciden con el correo"""
+        candidatas = self._remitentes.search(remitente.lower()) | self._sin_remitentes
+        if not candidatas:
+            return []
+
+        candidatas &= self._palabras.search(asunto.lower()) | self._sin_palabras
+        return [self.reglas[i] for i in sorted(candidatas)]
+
+
+class TokenBucket:
+    """Cubo de tokens: 'tasa' tokens por segundo con ráfagas de hasta 'capacidad'"""
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.ultimo = time.monotonic()
+
+    def reserve(self):
+        """Reserva un token y devuelve los segundos que hay que esperar para usarlo"""
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.tasa
+
+    def wait_time(self):
+        """Segundos hasta que haya un token libre, sin reservarlo"""
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+        self.ultimo = ahora
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.tasa
+
+
+class SendRateLimiter:
+    """
+    Limita el ritmo de envío por cuenta SMTP y, opcionalmente, por dominio de destino.
+    La espera la hace el hilo que envía, así que no retrasa a otras cuentas.
+    También registra los envíos del último minuto para consultarlos por la API.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # (tipo, clave) -> TokenBucket
+        self._envios = {}  # (tipo, clave) -> deque de instantes de envío
+        self._lock = threading.Lock()
+
+    def _bucket(self, clave, por_minuto, rafaga):
+        tasa = por_minuto / 60.0
+        bucket = self._buckets.get(clave)
+        if bucket is None:
+            bucket = self._buckets[clave] = TokenBucket(tasa, rafaga)
+        else:
+            # Recoger cambios de configuración
+            bucket.tasa = tasa
+            bucket.capacidad = rafaga
+        return bucket
+
+    def acquire(self, cuenta, dominio, por_minuto, rafaga, por_minuto_dominio=0, esperar=True):
+        """
+        Espera hasta que el envío cumpla los límites de la cuenta y del dominio.
+        Con esperar=False no duerme: si hay que esperar no reserva nada y devuelve
+        los segundos pendientes (0 si el envío puede hacerse ya).
+        """
+        with self._lock:
+            buckets = []
+            if por_minuto > 0:
+                buckets.append(self._bucket(('cuenta', cuenta), por_minuto, max(1, rafaga)))
+            if por_minuto_dominio > 0 and dominio:
+                buckets.append(self._bucket(('dominio', dominio), por_minuto_dominio, 1))
+            if not esperar:
+                pendiente = max([bucket.wait_time() for bucket in buckets], default=0)
+                if pendiente > 0:
+                    return pendiente
+            espera = max([bucket.reserve() for bucket in buckets], default=0)
+
+        if espera > 0:
+            time.sleep(espera)
+        return espera
+
+    def record_send(self, cuenta, dominio):
+        """Registra un envío realizado"""
+        ahora = time.time()
+        with self._lock:
+            for clave in (('cuenta', cuenta), ('dominio', dominio)):
+                self._envios.setdefault(clave, deque()).append(ahora)
+
+    def get_rates(self):
+        """Envíos del último minuto por cuenta y por dominio"""
+        limite = time.time() - 60
+        resultado = []
+
+        with self._lock:
+            for (tipo, clave), envios in list(self._envios.items()):
+                while envios and envios[0] < limite:
+                    envios.popleft()
+                if not envios:
+                    del self._envios[(tipo, clave)]
+                    continue
+                bucket = self._buckets.get((tipo, clave))
+                resultado.append({
+                    'tipo': tipo,
+                    'clave': clave,
+                    'envios_ultimo_minuto': len(envios),
+                    'limite_por_minuto': round(bucket.tasa * 60, 2) if bucket else None
+                })
+
+        return resultado
+
+
+class SMTPCircuitBreaker:
+    """
+    Cortacircuitos por servidor SMTP (servidor, puerto, usuario). Tras `umbral`
+    fallos de conexión seguidos el circuito se abre y los envíos a ese servidor se
+    aplazan sin intentarse; pasada la espera se deja pasar un único envío de
+    prueba. Si la prueba falla, la espera se duplica (hasta `espera_max`).
+    """
+
+    def __init__(self):
+        self._circuitos = {}  # clave -> estado del circuito
+        self._lock = threading.Lock()
+
+    def allow(self, clave):
+        """
+        Indica si se puede enviar al servidor. Devuelve (permitido, reanudar_en):
+        con el circuito abierto, reanudar_en es la hora a la que conviene volver a intentarlo.
+        """
+        ahora = time.time()
+        with self._lock:
+            circuito = self._circuitos.get(clave)
+            if circuito is None or circuito['estado'] == 'cerrado':
+                return True, None
+            if ahora >= circuito['abierto_hasta']:
+                # Envío de prueba: el resto sigue aplazado hasta conocer su resultado
+                circuito['estado'] = 'semiabierto'
+                circuito['abierto_hasta'] = ahora + circuito['espera']
+                return True, None
+            return False, circuito['abierto_hasta']
+
+    def record_success(self, clave):
+        """Registra un envío correcto; devuelve True si el circuito estaba abierto"""
+        with self._lock:
+            circuito = self._circuitos.pop(clave, None)
+        return circuito is not None and circuito['estado'] != 'cerrado'
+
+    def record_failure(self, clave, umbral, espera, espera_max):
+        """Registra un fallo de conexión; devuelve True si el circuito acaba de abrirse"""
+        ahora = time.time()
+        with self._lock:
+            circuito = self._circuitos.setdefault(clave, {
+                'estado': 'cerrado', 'fallos': 0, 'abierto_hasta': 0.0, 'espera': espera, 'ultimo_fallo': None
+            })
+            circuito['fallos'] += 1
+            circuito['ultimo_fallo'] = ahora
+            if circuito['estado'] == 'semiabierto':
+                # Falló la prueba: volver a abrir con más espera
+                circuito['espera'] = min(circuito['espera'] * 2, espera_max)
+            elif circuito['estado'] == 'cerrado' and circuito['fallos'] >= umbral:
+                circuito['espera'] = espera
+            else:
+                return False
+            circuito['estado'] = 'abierto'
+            circuito['abierto_hasta'] = ahora + circuito['espera']
+            return True
+
+    def get_state(self):
+        """Estado de los circuitos con fallos (para la API)"""
+        with self._lock:
+            items = list(self._circuitos.items())
+        return [{
+            'servidor': f"{clave[2]}@{clave[0]}:{clave[1]}",
+            'estado': circuito['estado'],
+            'fallos_consecutivos': circuito['fallos'],
+            'proxima_prueba': datetime.fromtimestamp(circuito['abierto_hasta']).isoformat()
+                              if circuito['estado'] != 'cerrado' else None,
+            'ultimo_fallo': datetime.fromtimestamp(circuito['ultimo_fallo']).isoformat()
+        } for clave, circuito in items]
+
+
+class MessageSpool:
+    """
+    Almacén en disco de correos originales (RFC822) direccionado por contenido:
+    cada correo se guarda una sola vez con su SHA-256 como nombre. La cola de
+    reintentos guarda solo el hash y el correo se lee al reenviarlo.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = Path(directorio)
+        self.directorio.mkdir(parents=True, exist_ok=True)
+
+    def _ruta(self, hash_correo):
+        return self.directorio / hash_correo[:2] / hash_correo
+
+    def path(self, hash_correo):
+        """Ruta del correo en el almacén (puede no existir)"""
+        return self._ruta(hash_correo)
+
+    def temp_path(self):
+        """Ruta para una descarga en curso (fuera de los subdirectorios que limpia gc)"""
+        return self.directorio / f"{threading.get_ident()}.{time.time_ns()}.parcial"
+
+    def put(self, datos):
+        """Guarda el correo (si no estaba ya) y devuelve su hash"""
+        hash_correo = hashlib.sha256(datos).hexdigest()
+        ruta = self._ruta(hash_correo)
+        if ruta.exists():
+            # Renovar la fecha para que la limpieza no lo borre mientras se usa
+            os.utime(ruta)
+            return hash_correo
+        ruta.parent.mkdir(exist_ok=True)
+        temporal = ruta.with_name(f"{hash_correo}.{threading.get_ident()}.tmp")
+        with open(temporal, 'wb') as f:
+            f.write(datos)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, ruta)
+        return hash_correo
+
+    def put_file(self, ruta):
+        """Mueve al almacén un correo ya descargado en disco y devuelve su hash"""
+        sha = hashlib.sha256()
+        with open(ruta, 'rb') as f:
+            for trozo in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(trozo)
+        hash_correo = sha.hexdigest()
+        destino = self._ruta(hash_correo)
+        if destino.exists():
+            os.utime(destino)
+            os.unlink(ruta)
+            return hash_correo
+        destino.parent.mkdir(exist_ok=True)
+        os.replace(ruta, destino)
+        return hash_correo
+
+    def gc(self, referenciados, gracia=3600):
+        """
+        Borra los correos que ninguna entrada de la cola referencia. Los modificados
+        hace menos de `gracia` segundos se conservan: pueden estar en pleno reenvío.
+        Devuelve el número de correos borrados.
+        """
+        limite = time.time() - gracia
+        borrados = 0
+        for ruta in self.directorio.glob('*/*'):
+            try:
+                if ruta.name in referenciados or ruta.stat().st_mtime > limite:
+                    continue
+                ruta.unlink()
+                borrados += 1
+            except FileNotFoundError:
+                pass
+        return borrados
+
+
+class RetryQueueStore:
+    """
+    Cola de reintentos persistente en SQLite (modo WAL): cada alta, actualización o
+    baja es una transacción atómica sobre una fila, sin reescribir la cola entera.
+    Si el correo está en el almacén (MessageSpool) solo se guarda su hash; si no,
+    los adjuntos se guardan serializados en MIME.
+    """
+
+    def __init__(self, ruta):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(ruta), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS reintentos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                proximo_intento REAL NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                timestamp_creacion TEXT NOT NULL,
+                asunto TEXT NOT NULL DEFAULT '',
+                destinatario TEXT NOT NULL DEFAULT '',
+                datos TEXT NOT NULL,
+                spool TEXT
+            )
+        """)
+        columnas = {fila[1] for fila in self._conn.execute("PRAGMA table_info(reintentos)")}
+        if 'spool' not in columnas:
+            self._conn.execute("ALTER TABLE reintentos ADD COLUMN spool TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_reintentos_proximo ON reintentos (proximo_intento)")
+
+    @staticmethod
+    def _encode(item):
+        """Serializa los datos del item (los adjuntos MIME como base64 de sus bytes)"""
+        mail_data = dict(item['mail_data'])
+        if mail_data.get('spool'):
+            # El cuerpo y los adjuntos se reconstruyen desde el almacén al reenviar
+            for campo in ('body_text', 'body_html', 'attachments'):
+                mail_data.pop(campo, None)
+        else:
+            mail_data['attachments'] = [
+                base64.b64encode(adjunto.as_bytes()).decode('ascii')
+                for adjunto in mail_data.get('attachments', [])
+            ]
+        return json.dumps({
+            'cuenta_config': item['cuenta_config'],
+            'mail_data': mail_data,
+            'regla': item['regla'],
+            'destinatario': item['destinatario'],
+            'include_attachments': item.get('include_attachments', False)
+        }, ensure_ascii=False)
+
+    @staticmethod
+    def _decode(fila):
+        id_item, proximo_intento, intentos, timestamp_creacion, datos = fila
+        item = json.loads(datos)
+        if 'attachments' in item['mail_data']:
+            item['mail_data']['attachments'] = [
+                email.message_from_bytes(base64.b64decode(a)) for a in item['mail_data']['attachments']
+            ]
+        item.update({
+            'id': id_item,
+            'proximo_intento': proximo_intento,
+            'intentos': intentos,
+            'timestamp_creacion': timestamp_creacion
+        })
+        return item
+
+    def add(self, item):
+        """Añade un item y devuelve su id"""
+        datos = self._encode(item)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO reintentos (proximo_intento, intentos, timestamp_creacion, asunto, destinatario, datos, spool) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (item['proximo_intento'], item.get('intentos', 0), item['timestamp_creacion'],
+                 item['mail_data'].get('subject', ''), item['destinatario'], datos, item['mail_data'].get('spool'))
+            )
+            return cursor.lastrowid
+
+    def update(self, id_item, intentos, proximo_intento):
+        """Actualiza el contador de intentos y la fecha del próximo intento"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE reintentos SET intentos = ?, proximo_intento = ? WHERE id = ?",
+                (intentos, proximo_intento, id_item)
+            )
+
+    def remove(self, id_item):
+        """Elimina un item (envío completado o descartado)"""
+        with self._lock:
+            self._conn.execute("DELETE FROM reintentos WHERE id = ?", (id_item,))
+
+    def get(self, id_item):
+        """Devuelve un item completo o None si ya no está en la cola"""
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT id, proximo_intento, intentos, timestamp_creacion, datos FROM reintentos WHERE id = ?",
+                (id_item,)
+            ).fetchone()
+        return self._decode(fila) if fila else None
+
+    def spool_refs(self):
+        """Hashes de los correos del almacén que siguen referenciados por la cola"""
+        with self._lock:
+            return {fila[0] for fila in self._conn.execute(
+                "SELECT DISTINCT spool FROM reintentos WHERE spool IS NOT NULL"
+            )}
+
+    def pending(self):
+        """Pares (id, proximo_intento) de todos los items, para planificarlos al arrancar"""
+        with self._lock:
+            return self._conn.execute("SELECT id, proximo_intento FROM reintentos").fetchall()
+
+    def summary(self):
+        """Resumen de la cola sin deserializar los correos (para la API)"""
+        with self._lock:
+            filas = self._conn.execute(
+                "SELECT id, asunto, destinatario, intentos, proximo_intento, timestamp_creacion "
+                "FROM reintentos ORDER BY proximo_intento"
+            ).fetchall()
+        return [{
+            'id': id_item,
+            'asunto': asunto,
+            'destinatario': destinatario,
+            'intentos': intentos,
+            'proximo_intento': proximo_intento,
+            'timestamp_creacion': timestamp_creacion
+        } for id_item, asunto, destinatario, intentos, proximo_intento, timestamp_creacion in filas]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM reintentos").fetchone()[0]
+
+    def stats(self):
+        """(nº de items, timestamp_creacion del más antiguo o None)"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*), MIN(timestamp_creacion) FROM reintentos").fetchone()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RetryScheduler:
+    """
+    Planificador de reintentos: montículo de (proximo_intento, id) atendido por un
+    hilo propio que duerme justo hasta el siguiente vencimiento. `procesar(id)`
+    devuelve la nueva hora de reintento o None si el item sale de la cola. Si
+    `procesar` lanza una excepción se avisa con `registrar_error` y el item se
+    vuelve a planificar dentro de `espera_error` segundos.
+    """
+
+    def __init__(self, procesar, registrar_error=print, espera_error=60):
+        self.procesar = procesar
+        self.registrar_error = registrar_error
+        self.espera_error = espera_error
+        self._heap = []
+        self._cond = threading.Condition()
+        self._detenido = False
+        self._hilo = None
+
+    def schedule(self, id_item, proximo_intento):
+        with self._cond:
+            heapq.heappush(self._heap, (proximo_intento, id_item))
+            # Despertar al hilo solo si el nuevo item vence antes que el que esperaba
+            if self._heap[0][1] == id_item:
+                self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def start(self):
+        self._detenido = False
+        self._hilo = threading.Thread(target=self._run, name="reintentos", daemon=True)
+        self._hilo.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._detenido = True
+            self._cond.notify_all()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._detenido:
+                    if self._heap:
+                        espera = self._heap[0][0] - time.time()
+                        if espera <= 0:
+                            break
+                        self._cond.wait(espera)
+                    else:
+                        self._cond.wait()
+                if self._detenido:
+                    return
+                _, id_item = heapq.heappop(self._heap)
+            
+            try:
+                proximo = self.procesar(id_item)
+            except Exception as e:
+                # Un item defectuoso no puede detener el hilo: se aplaza y se sigue con el resto
+                self.registrar_error(f"Error al procesar el reintento {id_item}: {e}")
+                proximo = time.time() + self.espera_error
+            if proximo is not None:
+                self.schedule(id_item, proximo)
+
+
+class LogSubscription:
+    """
+    Suscripción a las líneas nuevas de uno o varios logs (follow_logs). La cola es
+    acotada: si el cliente no da abasto se descartan líneas y se cuentan en
+    `perdidas`, sin frenar nunca al escritor de logs.
+    """
+
+    def __init__(self, rutas, max_cola):
+        self.rutas = rutas  # conjunto de rutas o None para todos los logs
+        self.cola = queue.Queue(max_cola)
+        self._perdidas = 0
+        self._lock = threading.Lock()
+
+    def offer(self, ruta, linea):
+        try:
+            self.cola.put_nowait((ruta, linea))
+        except queue.Full:
+            with self._lock:
+                self._perdidas += 1
+
+    def take_lost(self):
+        """Devuelve y pone a cero el contador de líneas descartadas"""
+        with self._lock:
+            perdidas, self._perdidas = self._perdidas, 0
+        return perdidas
+
+
+class LogWriter:
+    """
+    Escritor de logs en segundo plano: las líneas se encolan en memoria y un hilo
+    las escribe por lotes (un open por archivo y lote). Rota los archivos por
+    tamaño y/o al cambiar de día, comprimiendo los antiguos con gzip y
+    conservando como máximo `archivos_max` por log. Tras escribir cada lote,
+    las líneas se reparten a las suscripciones activas (follow_logs). Los archivos
+    registrados con `register` los escribe su propia función (p. ej. EventLog).
+    """
+
+    def __init__(self, intervalo=0.5, lote_max=1000):
+        self.intervalo = intervalo  # segundos máximos que una línea espera en memoria
+        self.lote_max = lote_max  # líneas pendientes que fuerzan la escritura inmediata
+        self.max_bytes = 10 * 1024 * 1024
+        self.diaria = False
+        self.archivos_max = 10
+        self._pendientes = deque()
+        self._cond = threading.Condition()
+        self._escribiendo = False
+        self._cerrado = False
+        self._suscripciones = []
+        self._suscripciones_lock = threading.Lock()
+        self._manejadores = {}  # ruta -> función que escribe sus líneas (sin rotación ni suscripciones)
+        self._hilo = threading.Thread(target=self._run, name="logs", daemon=True)
+        self._hilo.start()
+
+    def configure(self, max_bytes, diaria, archivos_max):
+        """Ajusta la rotación (0 bytes = sin rotación por tamaño)"""
+        self.max_bytes = max_bytes
+        self.diaria = diaria
+        self.archivos_max = max(1, archivos_max)
+
+    def write(self, ruta, linea):
+        """Encola una línea para el archivo indicado (no bloquea)"""
+        with self._cond:
+            if self._cerrado:
+                # Tras el cierre se escribe directamente (mensajes del apagado)
+                self._write_batch({ruta: [linea]})
+                return
+            self._pendientes.append((ruta, linea))
+            if len(self._pendientes) >= self.lote_max:
+                self._cond.notify()
+
+    def register(self, ruta, escribir):
+        """Las líneas encoladas para `ruta` las escribirá `escribir(lineas)` en el hilo de logs"""
+        self._manejadores[str(ruta)] = escribir
+
+    def subscribe(self, rutas=None, max_cola=1000):
+        """Crea una suscripción a las líneas nuevas de los logs indicados"""
+        suscripcion = LogSubscription(set(map(str, rutas)) if rutas else None, max_cola)
+        with self._suscripciones_lock:
+            self._suscripciones.append(suscripcion)
+        return suscripcion
+
+    def unsubscribe(self, suscripcion):
+        with self._suscripciones_lock:
+            if suscripcion in self._suscripciones:
+                self._suscripciones.remove(suscripcion)
+
+    def subscriber_count(self):
+        with self._suscripciones_lock:
+            return len(self._suscripciones)
+
+    def flush(self, timeout=10):
+        """Espera a que todo lo encolado esté en disco"""
+        limite = time.time() + timeout
+        with self._cond:
+            self._cond.notify()
+            while (self._pendientes or self._escribiendo) and time.time() < limite:
+                self._cond.wait(0.05)
+
+    def close(self):
+        """Vacía la cola y detiene el hilo"""
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify_all()
+        self._hilo.join(10)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pendientes and not self._cerrado:
+                    self._cond.wait(self.intervalo)
+                if not self._pendientes:
+                    if self._cerrado:
+                        return
+                    continue
+                lote = {}
+                while self._pendientes:
+                    ruta, linea = self._pendientes.popleft()
+                    lote.setdefault(ruta, []).append(linea)
+                self._escribiendo = True
+            try:
+                self._write_batch(lote)
+            finally:
+                with self._cond:
+                    self._escribiendo = False
+                    self._cond.notify_all()
+
+    def _write_batch(self, lote):
+        for ruta, lineas in lote.items():
+            try:
+                escribir = self._manejadores.get(str(ruta))
+                if escribir is not None:
+                    escribir(lineas)
+                    continue
+                self._rotate_if_needed(ruta)
+                with open(ruta, 'a', encoding='utf-8') as f:
+                    f.write(''.join(lineas))
+            except Exception as e:
+                print(f"Error crítico al escribir log {ruta}: {e}")
+        
+        with self._suscripciones_lock:
+            suscripciones = list(self._suscripciones)
+        for suscripcion in suscripciones:
+            for ruta, lineas in lote.items():
+                if str(ruta) in self._manejadores:
+                    continue
+                if suscripcion.rutas is None or str(ruta) in suscripcion.rutas:
+                    for linea in lineas:
+                        suscripcion.offer(ruta, linea)
+
+    def _rotate_if_needed(self, ruta):
+        try:
+            info = os.stat(ruta)
+        except FileNotFoundError:
+            return
+        por_tamano = self.max_bytes and info.st_size >= self.max_bytes
+        por_dia = self.diaria and datetime.fromtimestamp(info.st_mtime).date() != datetime.now().date()
+        if not (por_tamano or por_dia):
+            return
+        
+        ruta = Path(ruta)
+        archivado = ruta.with_name(f"{ruta.name}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+        os.replace(ruta, archivado)
+        with open(archivado, 'rb') as origen, gzip.open(f"{archivado}.gz", 'wb') as destino:
+            shutil.copyfileobj(origen, destino)
+        os.unlink(archivado)
+        
+        # Conservar solo los archivos más recientes
+        archivos = sorted(ruta.parent.glob(f"{ruta.name}.*.gz"))
+        for antiguo in archivos[:-self.archivos_max]:
+            antiguo.unlink(missing_ok=True)
+
+
+class LogFileIndex:
+    """
+    Lectura paginada de un archivo de log con un índice disperso: cada PASO líneas
+    se anota (nº de línea, byte de inicio, fecha). El índice solo lo usan las
+    consultas por nº de línea o por fechas: se amplía con lo añadido desde la
+    última de ellas y se rehace si el archivo rota. `tail` y `read_from` leen
+    directamente del archivo sin indexarlo.
+    """
+
+    PASO = 1000
+    BLOQUE = 64 * 1024
+
+    def __init__(self, ruta):
+        self.ruta = Path(ruta)
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inodo):
+        self.puntos = []  # (nº de línea, byte, fecha) cada PASO líneas
+        self.lineas = 0
+        self.fin = 0  # byte hasta el que está indexado (solo líneas completas)
+        self.inodo = inodo
+        self._ultima_fecha = ''
+
+    @staticmethod
+    def _fecha(linea):
+        """Fecha de una línea '[AAAA-MM-DD HH:MM:SS] ...' o None si no la tiene"""
+        if linea[:1] == b'[' and linea[20:21] == b']':
+            return linea[1:20].decode('ascii', errors='replace')
+        return None
+
+    def update(self):
+        """Indexa lo añadido al archivo desde la última vez y devuelve su tamaño"""
+        with self._lock:
+            try:
+                info = os.stat(self.ruta)
+            except FileNotFoundError:
+                self._reset(None)
+                return 0
+            if info.st_ino != self.inodo or info.st_size < self.fin:
+                # Archivo nuevo o rotado: rehacer el índice
+                self._reset(info.st_ino)
+            if info.st_size > self.fin:
+                with open(self.ruta, 'rb') as f:
+                    f.seek(self.fin)
+                    posicion = self.fin
+                    for linea in f:
+                        if not linea.endswith(b'\n'):
+                            break  # línea a medio escribir
+                        fecha = self._fecha(linea)
+                        if fecha:
+                            self._ultima_fecha = fecha
+                        if self.lineas % self.PASO == 0:
+                            self.puntos.append((self.lineas, posicion, fecha or self._ultima_fecha))
+                        self.lineas += 1
+                        posicion += len(linea)
+                    self.fin = posicion
+            return self.fin
+
+    def _size(self):
+        try:
+            return os.stat(self.ruta).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _read_forward(self, inicio, limite, saltar=0, desde=None, hasta=None, fin=None):
+        """Lee hasta `limite` líneas completas desde el byte `inicio` (hasta `fin`); devuelve (líneas, cursor)"""
+        fin = self.fin if fin is None else fin
+        lineas = []
+        cursor = inicio
+        dentro = desde is None
+        with open(self.ruta, 'rb') as f:
+            f.seek(inicio)
+            for linea in f:
+                if cursor >= fin or len(lineas) >= limite or not linea.endswith(b'\n'):
+                    break
+                fecha = self._fecha(linea)
+                if fecha and hasta is not None and fecha > hasta:
+                    break
+                cursor += len(linea)
+                if saltar:
+                    saltar -= 1
+                    continue
+                if not dentro:
+                    # Las líneas sin fecha pertenecen a la anterior
+                    if fecha is None or fecha < desde:
+                        continue
+                    dentro = True
+                lineas.append(linea.decode('utf-8', errors='replace'))
+        return lineas, cursor
+
+    def read_from(self, byte, limite):
+        """Líneas completas a partir de un byte (cursor de refresco incremental)"""
+        fin = self._size()
+        if byte > fin:
+            # El cursor es de un archivo ya rotado: empezar desde el principio
+            return self._read_forward(0, limite, fin=fin) + (True,)
+        return self._read_forward(byte, limite, fin=fin) + (False,)
+
+    def read_lines(self, offset, limite):
+        """Página de líneas a partir del nº de línea `offset`"""
+        self.update()
+        i = bisect.bisect_right(self.puntos, (offset, float('inf'))) - 1
+        if i < 0:
+            return self._read_forward(0, limite, saltar=offset)
+        linea, byte, _ = self.puntos[i]
+        return self._read_forward(byte, limite, saltar=offset - linea)
+
+    def read_range(self, desde, hasta, limite):
+        """Líneas entre dos fechas 'AAAA-MM-DD HH:MM:SS' (cualquiera puede ser None)"""
+        self.update()
+        inicio = 0
+        if desde:
+            fechas = [fecha for _, _, fecha in self.puntos]
+            i = bisect.bisect_left(fechas, desde) - 1
+            if i >= 0:
+                inicio = self.puntos[i][1]
+        return self._read_forward(inicio, limite, desde=desde or None, hasta=hasta or None)
+
+    def tail(self, n):
+        """Últimas `n` líneas completas, leyendo el archivo hacia atrás desde el final (sin indexarlo)"""
+        datos = b''
+        posicion = self._size()
+        with open(self.ruta, 'rb') as f:
+            while posicion > 0 and datos.count(b'\n') <= n:
+                leer = min(self.BLOQUE, posicion)
+                posicion -= leer
+                f.seek(posicion)
+                datos = f.read(leer) + datos
+        # Una última línea a medio escribir se deja para el siguiente refresco
+        datos = datos[:datos.rfind(b'\n') + 1]
+        fin = posicion + len(datos)
+        lineas = datos.splitlines(keepends=True)[-n:] if n else []
+        return [linea.decode('utf-8', errors='replace') for linea in lineas], fin
+
+
+class EventLog:
+    """
+    Registro estructurado de eventos (reenvíos, reintentos, bucles descartados y
+    errores) en JSONL, con un índice por bloques de BLOQUE eventos: rango de
+    fechas, valores de los campos de pocos valores (tipo, cuenta, regla, resultado)
+    y un filtro de Bloom para destinatario y message_id. Las consultas solo leen
+    los bloques que pueden contener resultados. Con `escritor` (LogWriter) la
+    escritura y el índice se hacen por lotes en el hilo de logs, no en quien registra.
+    """
+
+    BLOQUE = 500
+    BLOOM_BITS = 4096
+    CAMPOS_CONJUNTO = ('tipo', 'cuenta', 'regla', 'resultado')
+    CAMPOS_BLOOM = ('destinatario', 'message_id')
+
+    def __init__(self, ruta, ruta_indice, escritor=None):
+        self.ruta = Path(ruta)
+        self.ruta_indice = Path(ruta_indice)
+        self._lock = threading.Lock()
+        self.bloques = []  # zonas de los bloques cerrados (también en ruta_indice)
+        self._load()
+        self._archivo = open(self.ruta, 'ab')
+        self.escritor = escritor
+        if escritor is not None:
+            escritor.register(self.ruta, self._write_events)
+
+    @classmethod
+    def _bloom_positions(cls, valor):
+        digest = hashlib.blake2b(str(valor).lower().encode('utf-8'), digest_size=12).digest()
+        return [int.from_bytes(digest[i:i + 4], 'little') % cls.BLOOM_BITS for i in (0, 4, 8)]
+
+    def _new_zone(self, inicio):
+        return {'inicio': inicio, 'fin': inicio, 'n': 0, 'ts_min': None, 'ts_max': None,
+                **{campo: set() for campo in self.CAMPOS_CONJUNTO}, 'bloom': 0}
+
+    def _add_to_zone(self, zona, evento, longitud):
+        zona['fin'] += longitud
+        zona['n'] += 1
+        ts = evento.get('ts', 0)
+        zona['ts_min'] = ts if zona['ts_min'] is None else min(zona['ts_min'], ts)
+        zona['ts_max'] = ts if zona['ts_max'] is None else max(zona['ts_max'], ts)
+        for campo in self.CAMPOS_CONJUNTO:
+            if evento.get(campo) is not None:
+                zona[campo].add(evento[campo])
+        for campo in self.CAMPOS_BLOOM:
+            if evento.get(campo):
+                for posicion in self._bloom_positions(evento[campo]):
+                    zona['bloom'] |= 1 << posicion
+
+    def _load(self):
+        """Carga el índice y reconstruye el bloque abierto con lo escrito después"""
+        tamano = self.ruta.stat().st_size if self.ruta.exists() else 0
+        try:
+            with open(self.ruta_indice, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    zona = json.loads(linea)
+                    for campo in self.CAMPOS_CONJUNTO:
+                        zona[campo] = set(zona[campo])
+                    zona['bloom'] = int(zona['bloom'], 16)
+                    self.bloques.append(zona)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            self.bloques = []
+        
+        if self.bloques and self.bloques[-1]['fin'] > tamano:
+            # Índice de un archivo distinto o truncado: reconstruir
+            self.bloques = []
+        inicio = self.bloques[-1]['fin'] if self.bloques else 0
+        
+        self.abierto = self._new_zone(inicio)
+        reconstruir = not self.bloques and tamano > 0
+        with open(self.ruta, 'a+b') as f:
+            f.seek(inicio)
+            for linea in f:
+                if not linea.endswith(b'\n'):
+                    # Evento a medio escribir de una caída: se descarta
+                    f.truncate(self.abierto['fin'])
+                    break
+                try:
+                    evento = json.loads(linea)
+                except ValueError:
+                    evento = {}
+                self._add_to_zone(self.abierto, evento, len(linea))
+                if self.abierto['n'] >= self.BLOQUE:
+                    self.bloques.append(self.abierto)
+                    self.abierto = self._new_zone(self.abierto['fin'])
+        if reconstruir:
+            self._write_index()
+
+    def _zone_json(self, zona):
+        return json.dumps({**zona, **{campo: sorted(zona[campo], key=str) for campo in self.CAMPOS_CONJUNTO},
+                           'bloom': format(zona['bloom'], 'x')}, ensure_ascii=False) + '\n'
+
+    def _write_index(self):
+        temporal = self.ruta_indice.with_suffix('.tmp')
+        with open(temporal, 'w', encoding='utf-8') as f:
+            f.writelines(self._zone_json(zona) for zona in self.bloques)
+        os.replace(temporal, self.ruta_indice)
+
+    def record(self, evento):
+        """Añade un evento (dict); se le pone `ts` y `fecha` si no los trae"""
+        evento.setdefault('ts', time.time())
+        evento.setdefault('fecha', datetime.fromtimestamp(evento['ts']).strftime("%Y-%m-%d %H:%M:%S"))
+        linea = json.dumps(evento, ensure_ascii=False).encode('utf-8') + b'\n'
+        if self.escritor is not None:
+            self.escritor.write(self.ruta, (evento, linea))
+        else:
+            self._write_events([(evento, linea)])
+
+    def _write_events(self, eventos):
+        """Escribe un lote de (evento, línea) y actualiza el índice"""
+        cerrados = []
+        with self._lock:
+            self._archivo.write(b''.join(linea for _, linea in eventos))
+            self._archivo.flush()
+            for evento, linea in eventos:
+                self._add_to_zone(self.abierto, evento, len(linea))
+                if self.abierto['n'] >= self.BLOQUE:
+                    self.bloques.append(self.abierto)
+                    cerrados.append(self.abierto)
+                    self.abierto = self._new_zone(self.abierto['fin'])
+            if cerrados:
+                with open(self.ruta_indice, 'a', encoding='utf-8') as f:
+                    f.writelines(self._zone_json(zona) for zona in cerrados)
+
+    def _zone_may_match(self, zona, filtros, desde, hasta):
+        if zona['n'] == 0:
+            return False
+        if desde is not None and zona['ts_max'] < desde:
+            return False
+        if hasta is not None and zona['ts_min'] > hasta:
+            return False
+        for campo in self.CAMPOS_CONJUNTO:
+            if campo in filtros and filtros[campo] not in zona[campo]:
+                return False
+        for campo in self.CAMPOS_BLOOM:
+            if campo in filtros and any(not zona['bloom'] >> posicion & 1 for posicion in self._bloom_positions(filtros[campo])):
+                return False
+        return True
+
+    @classmethod
+    def _event_matches(cls, evento, filtros, desde, hasta):
+        ts = evento.get('ts', 0)
+        if (desde is not None and ts < desde) or (hasta is not None and ts > hasta):
+            return False
+        for campo, valor in filtros.items():
+            if campo in cls.CAMPOS_BLOOM:
+                if str(evento.get(campo, '')).lower() != str(valor).lower():
+                    return False
+            elif evento.get(campo) != valor:
+                return False
+        return True
+
+    def query(self, filtros, desde=None, hasta=None, limite=1000, recientes_primero=True):
+        """
+        Eventos que cumplen todos los filtros (igualdad por campo) entre dos marcas de
+        tiempo. Devuelve (eventos, bloques_leidos).
+        """
+        if self.escritor is not None:
+            self.escritor.flush()  # incluir los eventos aún en cola
+        with self._lock:
+            self._archivo.flush()
+            zonas = [zona for zona in self.bloques + [dict(self.abierto)]
+                     if self._zone_may_match(zona, filtros, desde, hasta)]
+        if recientes_primero:
+            zonas.reverse()
+        
+        eventos = []
+        with open(self.ruta, 'rb') as f:
+            for zona in zonas:
+                f.seek(zona['inicio'])
+                bloque = []
+                for linea in f.read(zona['fin'] - zona['inicio']).splitlines():
+                    try:
+                        evento = json.loads(linea)
+                    except ValueError:
+                        continue
+                    if self._event_matches(evento, filtros, desde, hasta):
+                        bloque.append(evento)
+                eventos.extend(reversed(bloque) if recientes_primero else bloque)
+                if len(eventos) >= limite:
+                    break
+        return eventos[:limite], len(zonas)
+
+    def close(self):
+        with self._lock:
+            self._archivo.close()
+
+
+class Metrics:
+    """
+    Métricas en memoria: contadores, medidores e histogramas de latencia con
+    etiquetas. Se consultan en JSON (get_metrics) o en el formato de texto de
+    Prometheus (endpoint HTTP en 127.0.0.1).
+    """
+
+    CUBETAS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, descripciones):
+        self.descripciones = descripciones  # nombre -> (tipo, ayuda)
+        self._lock = threading.Lock()
+        self._valores = {}  # (nombre, etiquetas) -> valor (contadores y medidores)
+        self._histogramas = {}  # (nombre, etiquetas) -> [cuenta por cubeta..., suma, total]
+
+    @staticmethod
+    def _clave(nombre, etiquetas):
+        return nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+    def inc(self, nombre, valor=1, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def set(self, nombre, valor, **etiquetas):
+        with self._lock:
+            self._valores[self._clave(nombre, etiquetas)] = valor
+
+    def observe(self, nombre, segundos, **etiquetas):
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            datos = self._histogramas.get(clave)
+            if datos is None:
+                datos = self._histogramas[clave] = [0] * (len(self.CUBETAS) + 3)
+            datos[bisect.bisect_left(self.CUBETAS, segundos)] += 1  # la última cubeta es +Inf
+            datos[-2] += segundos
+            datos[-1] += 1
+
+    @contextmanager
+    def timer(self, nombre, **etiquetas):
+        """Mide la duración del bloque (también si termina con una excepción)"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(nombre, time.perf_counter() - inicio, **etiquetas)
+
+    def snapshot(self):
+        """Métricas en JSON; los histogramas con sus cubetas acumuladas (`le` -> nº de observaciones)"""
+        with self._lock:
+            valores = dict(self._valores)
+            histogramas = {clave: list(datos) for clave, datos in self._histogramas.items()}
+        resultado = {'valores': [], 'histogramas': []}
+        for (nombre, etiquetas), valor in sorted(valores.items()):
+            resultado['valores'].append({'nombre': nombre, 'etiquetas': dict(etiquetas), 'valor': valor})
+        for (nombre, etiquetas), datos in sorted(histogramas.items()):
+            acumulado, cubetas = 0, {}
+            for limite, cuenta in zip(self.CUBETAS + ('+Inf',), datos[:-2]):
+                acumulado += cuenta
+                cubetas[str(limite)] = acumulado
+            resultado['histogramas'].append({
+                'nombre': nombre, 'etiquetas': dict(etiquetas), 'cubetas': cubetas,
+                'suma': round(datos[-2], 6), 'total': datos[-1],
+                'media': round(datos[-2] / datos[-1], 6) if datos[-1] else 0
+            })
+        return resultado
+
+    @staticmethod
+    def _etiquetas_texto(etiquetas):
+        if not etiquetas:
+            return ''
+        partes = []
+        for k, v in etiquetas:
+            v = v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            partes.append(f'{k}="{v}"')
+        return '{' + ','.join(partes) + '}'
+
+    def render_prometheus(self):
+        """Formato de exposición de texto de Prometheus (versión 0.0.4)"""
+        with self._lock:
+            valores = dict(self._valores)
+            histogramas = {clave: list(datos) for clave, datos in self._histogramas.items()}
+        lineas = []
+        nombres = sorted({n for n, _ in valores} | {n for n, _ in histogramas})
+        for nombre in nombres:
+            tipo, ayuda = self.descripciones.get(nombre, ('untyped', ''))
+            if ayuda:
+                lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for (n, etiquetas), valor in sorted(valores.items()):
+                if n == nombre:
+                    lineas.append(f"{nombre}{self._etiquetas_texto(etiquetas)} {valor}")
+            for (n, etiquetas), datos in sorted(histogramas.items()):
+                if n != nombre:
+                    continue
+                acumulado = 0
+                for limite, cuenta in zip(self.CUBETAS + ('+Inf',), datos[:-2]):
+                    acumulado += cuenta
+                    lineas.append(f"{nombre}_bucket{self._etiquetas_texto(etiquetas + (('le', str(limite)),))} {acumulado}")
+                lineas.append(f"{nombre}_sum{self._etiquetas_texto(etiquetas)} {datos[-2]}")
+                lineas.append(f"{nombre}_count{self._etiquetas_texto(etiquetas)} {datos[-1]}")
+        return '\n'.join(lineas) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Endpoint HTTP de métricas: GET /metrics en formato de texto de Prometheus"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        cuerpo = self.server.render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        pass  # cada consulta de Prometheus no debe llenar la salida del servicio
+
+
+class Tracer:
+    """
+    Trazas bajo demanda de las fases del ciclo (formato Chrome Trace Event:
+    chrome://tracing, Perfetto o speedscope), con perfil cProfile y memoria
+    (tracemalloc) opcionales. No tiene coste cuando está inactivo: el servidor
+    envuelve los métodos trazados al activarlo y quita las envolturas al terminar.
+    """
+
+    EVENTOS_MAX = 200000
+    MEMORIA_TOP = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.activo = False
+        self.ciclos_restantes = None
+        self._reset(False, False)
+
+    def _reset(self, perfilar, memoria):
+        self.inicio = time.perf_counter()
+        self.inicio_fecha = datetime.now().isoformat(timespec='seconds')
+        self.eventos = []
+        self.hilos = {}  # tid -> nombre del hilo
+        self.descartados = 0
+        self.perfilar = perfilar
+        self.perfil = None  # pstats.Stats acumulado de todos los hilos
+        self.memoria = memoria
+        self.memoria_top = None
+        self._tracemalloc_propio = False
+
+    def start(self, ciclos=None, perfilar=False, memoria=False):
+        with self._lock:
+            self._reset(perfilar, memoria)
+            self.ciclos_restantes = ciclos
+            if memoria and not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._tracemalloc_propio = True
+            self.activo = True
+
+    def stop(self):
+        with self._lock:
+            self.activo = False
+            if self.memoria and tracemalloc.is_tracing():
+                instantanea = tracemalloc.take_snapshot()
+                actual, pico = tracemalloc.get_traced_memory()
+                self.memoria_top = {
+                    'actual_kb': round(actual / 1024, 1),
+                    'pico_kb': round(pico / 1024, 1),
+                    'lineas': [{'lugar': str(stat.traceback), 'kb': round(stat.size / 1024, 1), 'bloques': stat.count}
+                               for stat in instantanea.statistics('lineno')[:self.MEMORIA_TOP]]
+                }
+                if self._tracemalloc_propio:
+                    tracemalloc.stop()
+
+    def cycle_finished(self):
+        """Cuenta un ciclo terminado; True si ya se han trazado todos los pedidos"""
+        with self._lock:
+            if self.ciclos_restantes is None:
+                return False
+            self.ciclos_restantes -= 1
+            return self.ciclos_restantes <= 0
+
+    @contextmanager
+    def span(self, nombre, args):
+        """Registra la duración del bloque como un tramo; perfila el hilo si no lo estaba ya"""
+        perfil = None
+        if self.perfilar and getattr(self._local, 'perfil', None) is None:
+            perfil = cProfile.Profile()
+            try:
+                perfil.enable()
+                self._local.perfil = perfil
+            except ValueError:
+                perfil = None  # ya hay otro perfilador activo en el hilo
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            fin = time.perf_counter()
+            if perfil is not None:
+                perfil.disable()
+                self._local.perfil = None
+            hilo = threading.current_thread()
+            with self._lock:
+                if self.activo:
+                    if perfil is not None:
+                        if self.perfil is None:
+                            self.perfil = pstats.Stats(perfil)
+                        else:
+                            self.perfil.add(perfil)
+                    if len(self.eventos) < self.EVENTOS_MAX:
+                        self.hilos[hilo.ident] = hilo.name
+                        self.eventos.append({
+                            'name': nombre, 'cat': 'percebe', 'ph': 'X', 'pid': os.getpid(), 'tid': hilo.ident,
+                            'ts': round((inicio - self.inicio) * 1e6, 1), 'dur': round((fin - inicio) * 1e6, 1),
+                            'args': args
+                        })
+                    else:
+                        self.descartados += 1
+
+    def result(self, lineas_perfil=40):
+        """Traza (Chrome Trace Event), resumen del perfil y memoria de la última sesión"""
+        with self._lock:
+            eventos = list(self.eventos)
+            hilos = dict(self.hilos)
+            perfil = None
+            if self.perfil is not None:
+                salida = io.StringIO()
+                self.perfil.stream = salida
+                self.perfil.sort_stats('cumulative').print_stats(lineas_perfil)
+                perfil = salida.getvalue()
+            memoria = self.memoria_top
+            descartados = self.descartados
+        metadatos = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': nombre}}
+                     for tid, nombre in hilos.items()]
+        traza = {
+            'traceEvents': metadatos + eventos,
+            'displayTimeUnit': 'ms',
+            'otherData': {'inicio': self.inicio_fecha, 'descartados': descartados}
+        }
+        return {'traza': traza, 'perfil': perfil, 'memoria': memoria}
+
+
+class SesionOcupadaError(Exception):
+    """La sesión IMAP de la cuenta está siendo usada por otro hilo"""
+
+
+class IMAPSessionManager:
+    """
+    Sesiones IMAP persistentes por cuenta, con INBOX seleccionado entre ciclos.
+    Cada sesión se usa en exclusiva (un lock por cuenta); al reutilizarla se
+    comprueba con NOOP y si se ha caído se reconecta de forma transparente.
+    """
+
+    def __init__(self, conectar):
+        self._conectar = conectar  # función que abre una conexión IMAP autenticada
+        self._sesiones = {}  # clave -> estado de la sesión
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._sesiones.get(key)
+            if entry is None:
+                entry = {
+                    'lock': threading.Lock(),
+                    'mail': None,
+                    'credenciales': None,
+                    'nombre': '',
+                    'estado': 'desconectada',
+                    'conectada_desde': None,
+                    'ultimo_uso': None,
+                    'reconexiones': 0,
+                    'ultimo_error': None
+                }
+                self._sesiones[key] = entry
+            return entry
+
+    @staticmethod
+    def _credenciales(cuenta_config):
+        return (cuenta_config.get('imap_server'), cuenta_config.get('imap_user'), cuenta_config.get('imap_password'))
+
+    @staticmethod
+    def _logout(mail):
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+    def _ensure(self, entry, cuenta_config):
+        """Devuelve la conexión viva de la sesión, reconectando si hace falta"""
+        credenciales = self._credenciales(cuenta_config)
+        mail = entry['mail']
+
+        if mail is not None and entry['credenciales'] == credenciales:
+            try:
+                if mail.state == 'SELECTED' and mail.noop()[0] == 'OK':
+                    return mail
+            except Exception:
+                pass
+
+        if mail is not None:
+            # Conexión caída o credenciales cambiadas: reconectar
+            self._logout(mail)
+            entry['mail'] = None
+
+        if entry['conectada_desde'] is not None:
+            entry['reconexiones'] += 1
+
+        mail = self._conectar(cuenta_config)
+        try:
+            status, _ = mail.select('INBOX')
+            if status != 'OK':
+                raise imaplib.IMAP4.error("No se pudo seleccionar INBOX")
+        except Exception:
+            self._logout(mail)
+            raise
+
+        entry['mail'] = mail
+        entry['credenciales'] = credenciales
+        entry['conectada_desde'] = time.time()
+        return mail
+
+    @contextmanager
+    def session(self, key, cuenta_config, espera=None):
+        """
+        Presta en exclusiva la sesión de la cuenta. Si espera no es None y la sesión
+        está ocupada más de esos segundos, lanza SesionOcupadaError.
+        """
+        entry = self._entry(key)
+        if not entry['lock'].acquire(timeout=-1 if espera is None else espera):
+            raise SesionOcupadaError("Sesión IMAP ocupada")
+
+        try:
+            entry['nombre'] = cuenta_config.get('nombre', '')
+            try:
+                mail = self._ensure(entry, cuenta_config)
+            except Exception as e:
+                entry['estado'] = 'caida'
+                entry['ultimo_error'] = str(e)
+                raise
+
+            entry['estado'] = 'en_uso'
+            try:
+                yield mail
+                entry['estado'] = 'conectada'
+            except (imaplib.IMAP4.abort, OSError) as e:
+                # Conexión perdida durante el uso: descartarla para reconectar la próxima vez
+                self._logout(mail)
+                entry['mail'] = None
+                entry['estado'] = 'caida'
+                entry['ultimo_error'] = str(e)
+                raise
+            except Exception:
+                entry['estado'] = 'conectada'
+                raise
+            finally:
+                entry['ultimo_uso'] = time.time()
+        finally:
+            entry['lock'].release()
+
+    def set_state(self, key, estado):
+        """Actualiza el estado informativo de una sesión en uso (p. ej. 'idle')"""
+        entry = self._entry(key)
+        entry['estado'] = estado
+
+    def prune(self, claves_validas):
+        """Cierra las sesiones libres de cuentas que ya no están configuradas"""
+        with self._lock:
+            candidatas = [(k, e) for k, e in self._sesiones.items() if k not in claves_validas]
+
+        for key, entry in candidatas:
+            if not entry['lock'].acquire(blocking=False):
+                continue  # En uso: se cerrará en otra pasada
+            try:
+                if entry['mail'] is not None:
+                    self._logout(entry['mail'])
+                with self._lock:
+                    self._sesiones.pop(key, None)
+            finally:
+                entry['lock'].release()
+
+    def close_all(self):
+        """Cierra todas las sesiones libres"""
+        self.prune(set())
+
+    def get_state(self):
+        """Estado de las sesiones para la API"""
+        def iso(ts):
+            return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+        with self._lock:
+            items = list(self._sesiones.items())
+
+        return [{
+            'cuenta': entry['nombre'],
+            'clave': key,
+            'estado': entry['estado'],
+            'conectada_desde': iso(entry['conectada_desde']) if entry['mail'] is not None else None,
+            'ultimo_uso': iso(entry['ultimo_uso']),
+            'reconexiones': entry['reconexiones'],
+            'ultimo_error': entry['ultimo_error']
+        } for key, entry in items]
 
 
 class PercebeServer:
     # Marca especial para detectar reenvíos (ΡCΒ: con espacio alt+255)
     REENVIO_MARKER = "ΡCΒ: "  # Rho griega C y Beta griega + dos puntos + espacio alt+255
-    DELAY_ENTRE_ENVIOS = 3  # Segundos de espera entre envíos a distintos destinatarios
     
     # Configuración de reintentos
     MAX_REINTENTOS = 50  # Máximo número de reintentos por correo
     REINTENTO_BASE_DELAY = 60  # Segundos base para el primer reintento (1 min)
     REINTENTO_MAX_DELAY = 3600  # Máximo delay entre reintentos (1 hora)
     
+    # Correos por comando FETCH al descargar solo cabeceras
+    LOTE_CABECERAS = 200
+    
+    # Descarga por partes de correos grandes (BODY.PEEK[]<inicio.longitud>)
+    TAMANO_PARTE = 1024 * 1024
+    
+    # Líneas devueltas por get_logs si no se pide otra cantidad, y máximo por página
+    LOG_LINEAS_POR_DEFECTO = 1000
+    LOG_LINEAS_MAX = 10000
+    
+    # follow_logs: clientes a la vez, líneas en cola por cliente y latido (segundos)
+    LOG_SEGUIDORES_MAX = 10
+    LOG_SEGUIMIENTO_COLA = 1000
+    LOG_SEGUIMIENTO_LATIDO = 15
+    
+    # API: segundos para recibir una petición y de inactividad en conexiones persistentes
+    API_TIMEOUT_PETICION = 5
+    API_TIMEOUT_INACTIVIDAD = 300
+    
+    # Modo IDLE: reemitir antes de los 30 minutos que permite el RFC 2177
+    IDLE_REFRESCO = 25 * 60
+    
+    # Métricas expuestas por get_metrics y el endpoint de Prometheus: nombre -> (tipo, ayuda)
+    METRICAS = {
+        'percebe_imap_conexion_segundos': ('histogram', 'Latencia de conexión y login IMAP'),
+        'percebe_imap_descarga_segundos': ('histogram', 'Latencia de las descargas IMAP (cabeceras, completo, partes)'),
+        'percebe_imap_errores_total': ('counter', 'Errores al procesar un buzón'),
+        'percebe_correos_total': ('counter', 'Correos nuevos procesados'),
+        'percebe_parseo_segundos': ('histogram', 'Tiempo de parseo del correo y de extracción de cuerpo y adjuntos'),
+        'percebe_reglas_segundos': ('histogram', 'Tiempo de evaluación de las reglas por correo'),
+        'percebe_smtp_envio_segundos': ('histogram', 'Latencia del envío SMTP (sesión del pool y sendmail)'),
+        'percebe_eventos_total': ('counter', 'Eventos registrados (reenvíos, reintentos, bucles y errores) por resultado'),
+        'percebe_ciclo_segundos': ('histogram', 'Duración de los ciclos de revisión'),
+        'percebe_ultimo_ciclo_timestamp': ('gauge', 'Fin del último ciclo de revisión (epoch)'),
+        'percebe_cola_reintentos': ('gauge', 'Correos en la cola de reintentos'),
+        'percebe_cola_reintentos_antiguedad_segundos': ('gauge', 'Antigüedad del correo más antiguo de la cola de reintentos'),
+    }
+    
+    # Métodos que cubren las trazas bajo demanda (start_trace).
+    # Quien los llame desde fuera de la clase debe resolverlos en cada llamada
+    # (lambda o getattr) para pasar por la envoltura mientras la traza está activa.
+    TRAZA_METODOS = ('run_check_cycle', 'process_mailbox', 'imap_connect', 'fetch_headers', 'fetch_full_message',
+                     'get_email_body', 'match_rules', 'render_forward_message', 'forward_email_single',
+                     'retry_item')
+    
     def __init__(self, config_dir="./percebe_config"):
         self.config_dir = Path(config_dir)
         self.config_file = self.config_dir / "config.json"
         self.log_file = self.config_dir / "reenvios.log"
         self.error_log_file = self.config_dir / "errores.log"
         self.debug_log_file = self.config_dir / "procesamiento.log"
-        self.retry_queue_file = self.config_dir / "cola_reintentos.json"
-        self.config = {}
+        self.retry_queue_file = self.config_dir / "cola_reintentos.json"  # formato antiguo (se migra)
+        self.retry_db_file = self.config_dir / "cola_reintentos.db"
+        self.sync_checkpoint_file = self.config_dir / "sincronizacion_imap.json"
+        self.event_log_file = self.config_dir / "eventos.jsonl"
+        self.event_index_file = self.config_dir / "eventos.idx"
+        self.trace_file = self.config_dir / "traza.json"
+        self.profile_file = self.config_dir / "traza.prof"
+        self.spool_dir = self.config_dir / "spool"
+        self.metrics = Metrics(self.METRICAS)
+        self.metrics_server = None
+        self.tracer = Tracer()
+        self.trace_lock = threading.Lock()
+        self.trace_timer = None
+        self.config = {}  # nunca se modifica en sitio: cada cambio publica un diccionario nuevo
+        self.config_lock = threading.Lock()  # serializa set_config/patch_config
+        self.config_version = 0  # se incrementa con cada cambio de configuración
+        self.config_etag = ''  # huella del contenido (get_config condicional y patch_config)
         self.running = False
         self.api_port = 5555
-        self.retry_queue = []
+        self.retry_store = None
+        self.retry_scheduler = RetryScheduler(lambda id_item: self.retry_item(id_item), self.log_error, self.REINTENTO_BASE_DELAY)
+        self.idle_watchers = {}  # cuenta -> evento para detener su hilo IDLE
+        self.idle_no_soportado = set()  # cuentas cuyo servidor no soporta IDLE
+        self.idle_lock = threading.Lock()
+        self.sync_checkpoints = {}  # cuenta -> {uidvalidity, ultimo_uid, highestmodseq}
+        self.sync_lock = threading.Lock()
+        self.rule_indexes = {}  # id(cuenta) -> (cuenta, RuleIndex); se vacía al cambiar la configuración
+        self.log_writer = LogWriter()
+        self.log_indexes = {}  # ruta -> LogFileIndex (lecturas paginadas de get_logs)
         
         # Crear directorio de configuración si no existe
         self.config_dir.mkdir(parents=True, exist_ok=True)
         
+        # Registro estructurado de eventos (consultable con query_events)
+        self.event_log = EventLog(self.event_log_file, self.event_index_file, self.log_writer)
+        
+        # Almacén de correos originales referenciados por la cola de reintentos
+        self.spool = MessageSpool(self.spool_dir)
+        
         # Cargar o crear configuración
         self.load_config()
+        self.apply_log_settings()
         self.load_retry_queue()
+        self.load_sync_checkpoints()
+
+        # Sesiones IMAP persistentes entre ciclos
+        self.imap_sessions = IMAPSessionManager(lambda cuenta_config: self.imap_connect(cuenta_config))
+        
+        # Limitador de ritmo de envío (sustituye a la espera fija entre destinatarios)
+        self.rate_limiter = SendRateLimiter()
+        
+        # Cortacircuitos por servidor SMTP (evita pagar timeouts contra servidores caídos)
+        self.smtp_breaker = SMTPCircuitBreaker()
+        
+        # Pool de sesiones SMTP reutilizables entre envíos
+        self.smtp_pool = SMTPConnectionPool(
+            timeout_inactividad=self.config.get('smtp_timeout_inactividad', 300)
+        )
     
     def load_config(self):
         """Carga la configuración desde el archivo JSON o crea uno vacío"""
@@ -68,6 +1790,14 @@ class PercebeServer:
             self.config = self._default_config()
             self.save_config()
             self.log_info("Archivo de configuración creado")
+        self.config_version = 1
+        self.config_etag = self.compute_config_etag(self.config)
+    
+    @staticmethod
+    def compute_config_etag(config):
+        """Huella del contenido de la configuración (no cambia al reiniciar el servidor)"""
+        contenido = json.dumps(config, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        return hashlib.sha256(contenido).hexdigest()[:16]
     
     def _default_config(self):
         """Estructura por defecto de la configuración"""
@@ -76,42 +1806,168 @@ class PercebeServer:
             "intervalo_revision": 60,  # segundos entre revisiones
             "api_enabled": True,
             "api_port": 5555,
-            "logs_completos": False  # Si está activado, registra detalles de procesamiento
+            "logs_completos": False,  # Si está activado, registra detalles de procesamiento
+            "smtp_timeout_inactividad": 300,  # segundos antes de cerrar una sesión SMTP sin uso
+            "max_cuentas_paralelas": 4,  # cuentas revisadas a la vez en cada ciclo
+            "imap_timeout": 60,  # segundos de timeout de las conexiones IMAP
+            "descarga_cabeceras_primero": True,  # descargar el correo completo solo si alguna regla coincide
+            "envios_por_minuto": 20,  # límite de envíos por cuenta SMTP (0 = sin límite)
+            "envios_rafaga": 5,  # envíos seguidos permitidos antes de aplicar el límite
+            "envios_por_minuto_dominio": 0,  # límite por dominio de destino (0 = sin límite)
+            "smtp_circuito_fallos": 5,  # fallos de conexión seguidos que abren el circuito de un servidor SMTP
+            "smtp_circuito_espera": 60,  # segundos antes del primer envío de prueba tras abrirse
+            "descarga_por_partes_umbral": 10 * 1024 * 1024,  # bytes a partir de los que un correo se descarga por partes a disco (0 = nunca)
+            "log_rotacion_mb": 10,  # tamaño a partir del cual se rota cada log (0 = sin límite)
+            "log_rotacion_diaria": False,  # rotar además al cambiar de día
+            "log_archivos_max": 10,  # archivos .gz que se conservan por log
+            "api_max_conexiones": 32,  # conexiones simultáneas a la API
+            "api_workers": 8,  # hilos que ejecutan los comandos de la API
+            "api_compresion_umbral": 1024,  # bytes a partir de los que se comprimen las respuestas (0 = nunca)
+            "metricas_puerto": 9555  # endpoint HTTP de métricas para Prometheus en 127.0.0.1 (0 = desactivado)
         }
     
+    def apply_log_settings(self):
+        """Aplica la configuración de rotación al escritor de logs"""
+        self.log_writer.configure(
+            int(self.config.get('log_rotacion_mb', 10) * 1024 * 1024),
+            self.config.get('log_rotacion_diaria', False),
+            self.config.get('log_archivos_max', 10)
+        )
+    
     def save_config(self):
-        """Guarda la configuración en el archivo JSON"""
+        """Guarda la configuración en el archivo JSON (se escribe aparte y se sustituye de golpe)"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
+            temporal = self.config_file.with_name(self.config_file.name + '.tmp')
+            with open(temporal, 'w', encoding='utf-8') as f:
                 json.dump(self.config, indent=4, fp=f, ensure_ascii=False)
+            os.replace(temporal, self.config_file)
             return True
         except Exception as e:
             self.log_error(f"Error al guardar configuración: {e}")
             return False
     
+    def publish_config(self, nueva):
+        """Sustituye la configuración por `nueva` y la guarda (llamar con config_lock tomado).
+
+        El diccionario anterior no se toca: el hilo de procesamiento sigue usando
+        la copia que leyó al empezar la cuenta o el ciclo.
+        """
+        self.config = nueva
+        self.config_version += 1
+        self.config_etag = self.compute_config_etag(nueva)
+        self.rule_indexes = {}
+        self.apply_log_settings()
+        return self.save_config()
+    
+    def config_conflict(self, data):
+        """Respuesta de error si el cliente partió de otra versión de la configuración, o None"""
+        etag = data.get('etag')
+        if etag is None or etag == self.config_etag:
+            return None
+        return {'status': 'error', 'conflicto': True,
+                'message': 'La configuración ha cambiado en el servidor; recárgala',
+                'version': self.config_version, 'etag': self.config_etag}
+    
+    def _patch_node(self, nodo, ruta, op, valor):
+        """Devuelve una copia de `nodo` con el cambio aplicado; solo se copia el camino modificado"""
+        if not ruta:
+            if op == 'add' and isinstance(nodo, list):
+                return nodo + [valor]
+            raise ValueError("La ruta debe terminar en una lista para 'add'")
+        if isinstance(nodo, list):
+            copia = list(nodo)
+            clave = ruta[0]
+            if isinstance(clave, bool) or not isinstance(clave, int) or not 0 <= clave < len(copia):
+                raise ValueError(f"Índice no válido: {clave!r}")
+        elif isinstance(nodo, dict):
+            copia = dict(nodo)
+            clave = ruta[0]
+            if not isinstance(clave, str):
+                raise ValueError(f"Clave no válida: {clave!r}")
+        else:
+            raise ValueError(f"Ruta no válida en {ruta[0]!r}")
+        
+        if len(ruta) == 1 and op == 'set':
+            copia[clave] = valor
+        elif len(ruta) == 1 and op == 'remove':
+            if clave not in copia and isinstance(copia, dict):
+                raise ValueError(f"No existe: {clave!r}")
+            del copia[clave]
+        else:
+            if isinstance(copia, dict) and clave not in copia:
+                raise ValueError(f"No existe: {clave!r}")
+            copia[clave] = self._patch_node(copia[clave], ruta[1:], op, valor)
+        return copia
+    
+    def patch_config(self, data):
+        """Aplica cambios puntuales a la configuración (comando patch_config).
+
+        Cada cambio es {'op': 'set' | 'add' | 'remove', 'ruta': [...], 'valor': ...}, p. ej.
+        {'op': 'set', 'ruta': ['cuentas', 0, 'reglas', 2, 'activa'], 'valor': False}.
+        'add' añade `valor` al final de la lista indicada. Se aplican todos o ninguno.
+        """
+        cambios = data.get('cambios')
+        if not isinstance(cambios, list) or not cambios:
+            return {'status': 'error', 'message': 'Faltan los cambios'}
+        
+        with self.config_lock:
+            conflicto = self.config_conflict(data)
+            if conflicto:
+                return conflicto
+            nueva = self.config
+            try:
+                for cambio in cambios:
+                    op = cambio.get('op')
+                    ruta = cambio.get('ruta')
+                    if op not in ('set', 'add', 'remove') or not isinstance(ruta, list):
+                        raise ValueError(f"Cambio no válido: {cambio!r}")
+                    if op != 'add' and not ruta:
+                        raise ValueError("La ruta no puede estar vacía")
+                    nueva = self._patch_node(nueva, ruta, op, cambio.get('valor'))
+            except (ValueError, AttributeError) as e:
+                return {'status': 'error', 'message': f'Cambio rechazado: {e}'}
+            
+            guardada = self.publish_config(nueva)
+            respuesta = {'status': 'ok' if guardada else 'error',
+                         'message': 'Configuración guardada' if guardada else 'Error al guardar',
+                         'version': self.config_version, 'etag': self.config_etag}
+        self.log_info(f"Configuración modificada ({len(cambios)} cambios, versión {self.config_version})")
+        return respuesta
+    
     def load_retry_queue(self):
-        """Carga la cola de reintentos desde el archivo JSON"""
+        """Abre la cola de reintentos persistente y migra la cola JSON antigua si existe"""
+        self.retry_store = RetryQueueStore(self.retry_db_file)
+        
         if self.retry_queue_file.exists():
-            try:
-                with open(self.retry_queue_file, 'r', encoding='utf-8') as f:
-                    self.retry_queue = json.load(f)
-                if self.retry_queue:
-                    self.log_info(f"Cola de reintentos cargada: {len(self.retry_queue)} correos pendientes")
-            except Exception as e:
-                self.log_error(f"Error al cargar cola de reintentos: {e}")
-                self.retry_queue = []
-        else:
-            self.retry_queue = []
+            self.migrate_retry_queue_json()
+        
+        pendientes = 0
+        for id_item, proximo_intento in self.retry_store.pending():
+            self.retry_scheduler.schedule(id_item, proximo_intento)
+            pendientes += 1
+        if pendientes:
+            self.log_info(f"Cola de reintentos cargada: {pendientes} correos pendientes")
     
-    def save_retry_queue(self):
-        """Guarda la cola de reintentos en el archivo JSON"""
+    def migrate_retry_queue_json(self):
+        """Importa la cola de reintentos de versiones anteriores (cola_reintentos.json)"""
         try:
-            with open(self.retry_queue_file, 'w', encoding='utf-8') as f:
-                json.dump(self.retry_queue, indent=4, fp=f, ensure_ascii=False)
-            return True
+            with open(self.retry_queue_file, 'r', encoding='utf-8') as f:
+                items = json.load(f)
         except Exception as e:
-            self.log_error(f"Error al guardar cola de reintentos: {e}")
-            return False
+            self.log_error(f"Error al cargar cola de reintentos antigua, se aparta como .corrupto: {e}")
+            os.replace(self.retry_queue_file, self.retry_queue_file.with_suffix('.json.corrupto'))
+            return
+        
+        migrados = 0
+        for item in items:
+            try:
+                self.retry_store.add(item)
+                migrados += 1
+            except Exception as e:
+                self.log_error(f"Error al migrar item de la cola de reintentos: {e}")
+        
+        os.replace(self.retry_queue_file, self.retry_queue_file.with_suffix('.json.migrado'))
+        self.log_info(f"Cola de reintentos migrada a SQLite: {migrados} correos")
     
     def add_to_retry_queue(self, cuenta_config, mail_data, regla, destinatario, include_attachments=False):
         """Añade un correo a la cola de reintentos"""
@@ -126,91 +1982,144 @@ class PercebeServer:
             'timestamp_creacion': datetime.now().isoformat()
         }
         
-        self.retry_queue.append(retry_item)
-        self.save_retry_queue()
+        id_item = self.retry_store.add(retry_item)
+        self.retry_scheduler.schedule(id_item, retry_item['proximo_intento'])
         self.log_info(f"Correo añadido a cola de reintentos: {mail_data['subject']} -> {destinatario}")
     
-    def process_retry_queue(self):
-        """Procesa la cola de reintentos"""
-        if not self.retry_queue:
-            return
+    def retry_delay(self, intentos):
+        """Segundos hasta el siguiente intento (backoff exponencial con tope)"""
+        return min(self.REINTENTO_BASE_DELAY * (2 ** intentos), self.REINTENTO_MAX_DELAY)
+    
+    def retry_item(self, id_item):
+        """
+        Reintenta un item vencido de la cola (lo llama el hilo de reintentos).
+        Devuelve la hora del próximo intento, o None si el item sale de la cola.
+        """
+        try:
+            item = self.retry_store.get(id_item)
+        except Exception as e:
+            self.log_error(f"Error al leer item {id_item} de la cola de reintentos: {e}")
+            return time.time() + self.REINTENTO_BASE_DELAY
         
-        self.log_debug(f"Procesando cola de reintentos: {len(self.retry_queue)} items")
+        if item is None:
+            return None
         
-        now = time.time()
-        items_to_remove = []
-        items_to_update = []
+        if item['mail_data'].get('spool') and 'attachments' not in item['mail_data']:
+            # Cuerpo y adjuntos desde el almacén, solo en el momento de reenviar
+            ruta = self.spool.path(item['mail_data']['spool'])
+            if not ruta.exists():
+                self.retry_store.remove(id_item)
+                self.log_event('reintento', item['cuenta_config'], item['mail_data'], item['regla'], item['destinatario'],
+                               resultado='descartado', intento=item['intentos'] + 1)
+                self.log_error(f"Correo original no encontrado en el almacén, se descarta el reintento: {item['mail_data']['subject']} -> {item['destinatario']}")
+                return None
+            try:
+                with self.metrics.timer('percebe_parseo_segundos', fase='reintento'):
+                    item['mail_data']['body_text'], item['mail_data']['body_html'], item['mail_data']['attachments'] = \
+                        self.get_email_body(self.parse_message_file(ruta), item['include_attachments'])
+            except Exception as e:
+                # Archivo ilegible o dañado: cuenta como intento fallido (al llegar al máximo se descarta)
+                intentos = item['intentos'] + 1
+                descartar = intentos >= self.MAX_REINTENTOS
+                self.log_event('reintento', item['cuenta_config'], item['mail_data'], item['regla'], item['destinatario'],
+                               resultado='descartado' if descartar else 'error', intento=intentos)
+                self.log_error(f"No se pudo leer el correo del almacén para {item['mail_data']['subject']} -> {item['destinatario']}: {e}")
+                if descartar:
+                    self.retry_store.remove(id_item)
+                    return None
+                proximo_intento = time.time() + self.retry_delay(intentos)
+                self.retry_store.update(id_item, intentos, proximo_intento)
+                return proximo_intento
         
-        for i, item in enumerate(self.retry_queue):
-            # Verificar si es momento de reintentar
-            if item['proximo_intento'] > now:
-                continue
-            
-            self.log_debug(f"Reintentando envío (intento {item['intentos'] + 1}/{self.MAX_REINTENTOS}): {item['mail_data']['subject']} -> {item['destinatario']}")
-            
-            # Intentar reenviar
+        permitido, reanudar_en = self.smtp_breaker.allow(SMTPConnectionPool.pool_key(item['cuenta_config']))
+        if not permitido:
+            # Circuito abierto: aplazar sin gastar un intento
+            self.retry_store.update(id_item, item['intentos'], reanudar_en)
+            return reanudar_en
+        
+        # El hilo de reintentos es único: en vez de dormir por el límite de envíos, se aplaza el item
+        espera = self.acquire_send_slot(item['cuenta_config'], item['destinatario'], esperar=False)
+        if espera > 0:
+            proximo_intento = time.time() + espera
+            self.retry_store.update(id_item, item['intentos'], proximo_intento)
+            return proximo_intento
+        
+        self.log_debug(f"Reintentando envío (intento {item['intentos'] + 1}/{self.MAX_REINTENTOS}): {item['mail_data']['subject']} -> {item['destinatario']}")
+        
+        # Intentar reenviar
+        inicio = time.time()
+        try:
             success = self.forward_email_single(
                 item['cuenta_config'],
                 item['mail_data'],
                 item['regla'],
                 item['destinatario'],
-                item['include_attachments']
+                item['include_attachments'],
+                hueco_reservado=True
             )
-            
-            if success:
-                # Éxito: marcar para eliminar de la cola
-                items_to_remove.append(i)
-                self.log_info(f"Reintento exitoso: {item['mail_data']['subject']} -> {item['destinatario']}")
-            else:
-                # Fallo: incrementar contador de intentos
-                item['intentos'] += 1
-                
-                if item['intentos'] >= self.MAX_REINTENTOS:
-                    # Máximo de reintentos alcanzado: eliminar y registrar error
-                    items_to_remove.append(i)
-                    self.log_error(f"Máximo de reintentos alcanzado para: {item['mail_data']['subject']} -> {item['destinatario']}")
-                else:
-                    # Calcular próximo intento con backoff exponencial
-                    delay = min(
-                        self.REINTENTO_BASE_DELAY * (2 ** item['intentos']),
-                        self.REINTENTO_MAX_DELAY
-                    )
-                    item['proximo_intento'] = now + delay
-                    items_to_update.append(i)
-                    
-                    proximo_str = datetime.fromtimestamp(item['proximo_intento']).strftime("%H:%M:%S")
-                    self.log_info(f"Reintento fallido. Próximo intento a las {proximo_str} (delay: {delay}s)")
+        except Exception as e:
+            self.log_error(f"Error inesperado al reintentar envío: {e}")
+            success = False
+        
+        resultado = 'ok' if success else ('descartado' if item['intentos'] + 1 >= self.MAX_REINTENTOS else 'error')
+        self.log_event('reintento', item['cuenta_config'], item['mail_data'], item['regla'], item['destinatario'],
+                       resultado=resultado, intento=item['intentos'] + 1, latencia_ms=round((time.time() - inicio) * 1000))
         
-        # Eliminar items completados o que excedieron reintentos
-        for i in sorted(items_to_remove, reverse=True):
-            del self.retry_queue[i]
+        if success:
+            # Éxito: eliminar de la cola
+            self.retry_store.remove(id_item)
+            self.log_info(f"Reintento exitoso: {item['mail_data']['subject']} -> {item['destinatario']}")
+            return None
         
-        # Guardar cola actualizada si hubo cambios
-        if items_to_remove or items_to_update:
-            self.save_retry_queue()
-            self.log_debug(f"Cola de reintentos actualizada: {len(self.retry_queue)} items restantes")
+        # Fallo: incrementar contador de intentos
+        intentos = item['intentos'] + 1
+        
+        if intentos >= self.MAX_REINTENTOS:
+            # Máximo de reintentos alcanzado: eliminar y registrar error
+            self.retry_store.remove(id_item)
+            self.log_error(f"Máximo de reintentos alcanzado para: {item['mail_data']['subject']} -> {item['destinatario']}")
+            return None
+        
+        # Calcular próximo intento con backoff exponencial
+        delay = self.retry_delay(intentos)
+        proximo_intento = time.time() + delay
+        self.retry_store.update(id_item, intentos, proximo_intento)
+        
+        proximo_str = datetime.fromtimestamp(proximo_intento).strftime("%H:%M:%S")
+        self.log_info(f"Reintento fallido. Próximo intento a las {proximo_str} (delay: {delay}s)")
+        return proximo_intento
     
     def log_reenvio(self, asunto, regla_nombre, destinatario):
         """Registra un reenvío en el log"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_entry = f"[{timestamp}] Asunto: {asunto} | Regla: {regla_nombre} | Destinatario: {destinatario}\n"
-        
-        try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                f.write(log_entry)
-        except Exception as e:
-            self.log_error(f"Error al escribir log de reenvío: {e}")
+        self.log_writer.write(self.log_file, log_entry)
     
     def log_error(self, mensaje):
         """Registra un error en el log de errores"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_entry = f"[{timestamp}] ERROR: {mensaje}\n"
-        
+        self.log_writer.write(self.error_log_file, log_entry)
+        self.log_event('error', resultado='error', detalle=mensaje)
+    
+    def log_event(self, tipo, cuenta_config=None, mail_data=None, regla=None, destinatario=None, **campos):
+        """Añade un evento al registro estructurado (eventos.jsonl)"""
+        evento = {'tipo': tipo}
+        if cuenta_config is not None:
+            evento['cuenta'] = cuenta_config.get('nombre', self.account_key(cuenta_config))
+        if mail_data is not None:
+            evento['asunto'] = mail_data.get('subject', '')
+            evento['message_id'] = mail_data.get('message_id', '')
+        if regla is not None:
+            evento['regla'] = regla.get('nombre', '')
+        if destinatario is not None:
+            evento['destinatario'] = destinatario
+        evento.update(campos)
+        self.metrics.inc('percebe_eventos_total', tipo=tipo, resultado=campos.get('resultado', ''))
         try:
-            with open(self.error_log_file, 'a', encoding='utf-8') as f:
-                f.write(log_entry)
+            self.event_log.record(evento)
         except Exception as e:
-            print(f"Error crítico al escribir log de errores: {e}")
+            print(f"Error al escribir evento: {e}")
     
     def log_info(self, mensaje):
         """Imprime información en consola (para systemd journal)"""
@@ -224,12 +2133,130 @@ class PercebeServer:
         
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_entry = f"[{timestamp}] DEBUG: {mensaje}\n"
+        self.log_writer.write(self.debug_log_file, log_entry)
+    
+    def log_files(self):
+        """Tipos de log que expone la API y su archivo"""
+        return {
+            'reenvios': self.log_file,
+            'errores': self.error_log_file,
+            'procesamiento': self.debug_log_file
+        }
+    
+    async def follow_logs(self, peticion, enviar, reader):
+        """
+        Envía al cliente las líneas de log según se escriben ({"log_type": ..., "linea": ...}).
+        `enviar` es la corrutina de la conexión que manda una lista de mensajes (como
+        tramas o como JSON por línea) y espera a que el cliente los reciba. Si el cliente
+        no lee a tiempo, su cola acotada descarta líneas y se le avisa con {"perdidas": n};
+        cada LOG_SEGUIMIENTO_LATIDO segundos sin actividad se envía {"latido": true}.
+        """
+        archivos = self.log_files()
+        tipos = peticion.get('log_types') or list(archivos)
+        tipos_por_ruta = {str(archivos[t]): t for t in tipos if t in archivos}
+        
+        if not tipos_por_ruta:
+            await enviar([{'status': 'error', 'message': 'Tipo de log desconocido'}])
+            return
+        if self.log_writer.subscriber_count() >= self.LOG_SEGUIDORES_MAX:
+            await enviar([{'status': 'error', 'message': 'Demasiados clientes siguiendo los logs'}])
+            return
         
+        suscripcion = self.log_writer.subscribe(tipos_por_ruta, self.LOG_SEGUIMIENTO_COLA)
+        # Termina cuando el cliente cierra la conexión
+        cierre = asyncio.ensure_future(reader.read())
         try:
-            with open(self.debug_log_file, 'a', encoding='utf-8') as f:
-                f.write(log_entry)
-        except Exception as e:
-            print(f"Error al escribir log de debug: {e}")
+            await enviar([{'status': 'ok', 'log_types': list(tipos_por_ruta.values())}])
+            silencio = 0.0
+            while self.running and not cierre.done():
+                pendientes = []
+                while len(pendientes) < self.LOG_SEGUIMIENTO_COLA:
+                    try:
+                        pendientes.append(suscripcion.cola.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                if not pendientes:
+                    await asyncio.sleep(0.2)
+                    silencio += 0.2
+                    if silencio >= self.LOG_SEGUIMIENTO_LATIDO:
+                        await enviar([{'latido': True}])
+                        silencio = 0.0
+                    continue
+                silencio = 0.0
+                
+                mensajes = []
+                perdidas = suscripcion.take_lost()
+                if perdidas:
+                    mensajes.append({'perdidas': perdidas})
+                mensajes.extend({'log_type': tipos_por_ruta[str(ruta)], 'linea': linea} for ruta, linea in pendientes)
+                await enviar(mensajes)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass  # cliente desconectado o sin leer
+        finally:
+            self.log_writer.unsubscribe(suscripcion)
+            cierre.cancel()
+    
+    def query_events(self, peticion):
+        """
+        Consulta del registro de eventos para la API. Filtros por igualdad: tipo, cuenta,
+        regla, destinatario, message_id, resultado; rango con desde/hasta
+        ('AAAA-MM-DD HH:MM:SS'); `limite` eventos, los más recientes primero.
+        """
+        campos = EventLog.CAMPOS_CONJUNTO + EventLog.CAMPOS_BLOOM
+        filtros = {campo: peticion[campo] for campo in campos if peticion.get(campo) not in (None, '')}
+        try:
+            desde = datetime.fromisoformat(peticion['desde']).timestamp() if peticion.get('desde') else None
+            hasta = datetime.fromisoformat(peticion['hasta']).timestamp() if peticion.get('hasta') else None
+        except ValueError:
+            return {'status': 'error', 'message': 'Fecha no válida (formato AAAA-MM-DD HH:MM:SS)'}
+        
+        limite = max(0, min(int(peticion.get('limite', self.LOG_LINEAS_POR_DEFECTO)), self.LOG_LINEAS_MAX))
+        eventos, bloques = self.event_log.query(filtros, desde, hasta, limite, peticion.get('orden', 'desc') != 'asc')
+        return {'status': 'ok', 'data': eventos, 'bloques_leidos': bloques, 'bloques_totales': len(self.event_log.bloques) + 1}
+    
+    def read_logs(self, log_file, peticion):
+        """
+        Lectura paginada de un log para get_logs. Modos, por prioridad:
+        - desde_byte: líneas añadidas desde el cursor de una lectura anterior
+        - desde / hasta: rango de fechas ('AAAA-MM-DD HH:MM:SS'), usando el índice disperso
+        - offset: página por nº de línea
+        - tail (por defecto): últimas N líneas
+        `limite` acota las líneas devueltas (también en tail); la respuesta incluye `cursor`
+        (byte tras la última línea devuelta) para pedir solo lo nuevo en el siguiente
+        refresco. `total_lineas` solo se calcula en los modos que usan el índice (offset y
+        fechas); en los demás es None para no recorrer el archivo entero.
+        """
+        self.log_writer.flush()
+        if not log_file.exists():
+            return {'status': 'ok', 'data': [], 'cursor': 0, 'total_lineas': 0}
+        
+        indice = self.log_indexes.get(log_file)
+        if indice is None:
+            indice = self.log_indexes.setdefault(log_file, LogFileIndex(log_file))
+        
+        limite = max(0, min(int(peticion.get('limite', self.LOG_LINEAS_MAX)), self.LOG_LINEAS_MAX))
+        reiniciado = False
+        
+        if peticion.get('desde_byte') is not None:
+            lineas, cursor, reiniciado = indice.read_from(int(peticion['desde_byte']), limite)
+        elif peticion.get('desde') or peticion.get('hasta'):
+            lineas, cursor = indice.read_range(peticion.get('desde'), peticion.get('hasta'), limite)
+        elif peticion.get('offset') is not None:
+            lineas, cursor = indice.read_lines(max(0, int(peticion['offset'])), limite)
+        else:
+            tail = int(peticion.get('tail', self.LOG_LINEAS_POR_DEFECTO))
+            lineas, cursor = indice.tail(max(0, min(tail, limite)))
+        
+        indexado = peticion.get('desde_byte') is None and (
+            peticion.get('desde') or peticion.get('hasta') or peticion.get('offset') is not None)
+        return {
+            'status': 'ok',
+            'data': lineas,
+            'cursor': cursor,
+            'reiniciado': reiniciado,
+            'total_lineas': indice.lineas if indexado else None
+        }
     
     def decode_mime_header(self, header):
         """Decodifica headers MIME codificados"""
@@ -261,50 +2288,28 @@ class PercebeServer:
             return True
         return False
     
-    def check_rule_match(self, mail_data, regla):
-        """Verifica si un correo coincide con una regla"""
-        # Verificar remitente (si hay remitentes especificados)
-        remitentes_config = regla.get("remitentes", [])
-        
-        # Si la lista está vacía o no existe, se acepta cualquier remitente
-        if remitentes_config:
-            remitente_match = False
-            for rem in remitentes_config:
-                if rem.lower() in mail_data["from"].lower():
-                    remitente_match = True
-                    self.log_debug(f"Regla '{regla.get('nombre')}': Remitente coincide con '{rem}'")
-                    break
-            
-            if not remitente_match:
-                self.log_debug(f"Regla '{regla.get('nombre')}': Remitente '{mail_data['from']}' NO coincide con ninguno configurado")
-                return False
-        else:
-            self.log_debug(f"Regla '{regla.get('nombre')}': Sin filtro de remitentes (acepta cualquiera)")
-        
-        # Verificar palabras clave en asunto (si hay palabras especificadas)
-        palabras_config = regla.get("palabras_clave", [])
-        
-        # Si la lista está vacía o no existe, se acepta cualquier asunto
-        if palabras_config:
-            asunto_lower = mail_data["subject"].lower()
-            keyword_match = False
-            for keyword in palabras_config:
-                if keyword.lower() in asunto_lower:
-                    keyword_match = True
-                    self.log_debug(f"Regla '{regla.get('nombre')}': Palabra clave '{keyword}' encontrada en asunto")
-                    break
-            
-            if not keyword_match:
-                self.log_debug(f"Regla '{regla.get('nombre')}': Asunto '{mail_data['subject']}' NO contiene ninguna palabra clave")
-                return False
-        else:
-            self.log_debug(f"Regla '{regla.get('nombre')}': Sin filtro de palabras clave (acepta cualquier asunto)")
+    def match_rules(self, rule_index, mail_data):
+        """Reglas activas que coinciden con el correo (una sola pasada por el índice)"""
+        with self.metrics.timer('percebe_reglas_segundos'):
+            return rule_index.match(mail_data['from'], mail_data['subject'])
+    
+    def get_rule_index(self, cuenta_config):
+        """Índice compilado de las reglas de la cuenta (se reconstruye si cambia la configuración)"""
+        cached = self.rule_indexes.get(id(cuenta_config))
         
-        self.log_debug(f"Regla '{regla.get('nombre')}': COINCIDE con el correo")
-        return True
-
-    def get_email_body(self, msg):
-        """Extrae el cuerpo del correo (texto plano, HTML y adjuntos)"""
+        # Se guarda la propia cuenta junto al índice para que su id no pueda reutilizarse
+        if cached is not None and cached[0] is cuenta_config:
+            return cached[1]
+        
+        rule_index = RuleIndex(cuenta_config.get('reglas', []))
+        self.rule_indexes[id(cuenta_config)] = (cuenta_config, rule_index)
+        return rule_index
+    
+    def get_email_body(self, msg, include_attachments=True):
+        """
+        Extrae el cuerpo del correo (texto plano, HTML y adjuntos)
+        Los adjuntos solo se extraen si alguna regla los reenvía (include_attachments)
+        """
         body_text = ""
         body_html = ""
         attachments = []
@@ -317,17 +2322,10 @@ class PercebeServer:
                 # Si es adjunto
                 if "attachment" in content_disposition:
                     filename = part.get_filename()
-                    if filename:
+                    if filename and include_attachments:
                         try:
-                            # Decodificar nombre (por si tiene caracteres MIME)
-                            decoded_name = self.decode_mime_header(filename)
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                # Crear objeto MIME para reenviar
-                                attachment = MIMEBase(part.get_content_maintype(), part.get_content_subtype())
-                                attachment.set_payload(payload)
-                                encoders.encode_base64(attachment)
-                                attachment.add_header('Content-Disposition', 'attachment', filename=decoded_name)
+                            attachment = self.forwardable_attachment(part, filename)
+                            if attachment is not None:
                                 attachments.append(attachment)
                         except Exception as e:
                             self.log_error(f"Error al procesar adjunto '{filename}': {e}")
@@ -362,107 +2360,201 @@ class PercebeServer:
 
         return body_text, body_html, attachments
 
-    def forward_email_single(self, cuenta_config, mail_data, regla, destinatario, include_attachments=False):
+    def forwardable_attachment(self, part, filename):
         """
-        Reenvía un correo a UN SOLO destinatario
-        Versión 2.1 - Con manejo de errores de conexión
+        Prepara un adjunto para reenviarlo. Si ya viene en base64, quoted-printable o
+        7bit se reutiliza la parte original tal cual, sin decodificar ni volver a
+        codificar; solo los adjuntos 8bit/binary (que no todo servidor SMTP acepta)
+        se decodifican y pasan a base64.
         """
-        try:
-            msg = MIMEMultipart('mixed') 
-            
-            # ===== CABECERAS CRÍTICAS ANTI-SPAM =====
-            msg['From'] = cuenta_config['smtp_user']
-            msg['To'] = destinatario
-            
-            # 1. Message-ID (CRÍTICO - elimina ~4.29 puntos de spam)
-            domain = cuenta_config['smtp_user'].split('@')[-1]
-            random_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-            timestamp = int(time.time())
-            msg['Message-ID'] = f"<{random_id}.{timestamp}@{domain}>"
-            
-            # 2. Date (CRÍTICO - elimina ~1.36 puntos de spam)
-            msg['Date'] = formatdate(localtime=True)
-            
-            # 3. Asunto con marca de reenvío
-            msg['Subject'] = f"{self.REENVIO_MARKER}{mail_data['subject']}"
-            
-            # 4. Cabeceras adicionales recomendadas
-            msg['MIME-Version'] = '1.0'
-            msg['X-Mailer'] = 'P.E.R.C.E.B.E. v2.1'
-            
-            # 5. Cabeceras de procedencia (ayudan a la trazabilidad)
-            msg['X-Forwarded-From'] = mail_data['from']
-            msg['X-Original-Date'] = mail_data['date']
-            
-            # ===== CONSTRUCCIÓN DEL CUERPO (MEJORADA) =====
-            # Crear el contenedor 'alternative' para texto/HTML
-            msg_alternative = MIMEMultipart('alternative')
-            
-            # Encabezado de reenvío (versión completa del nombre del programa)
-            header_info = f"\n\n--- Correo reenviado automáticamente por Programa de Envío y Redirección de Correo Eliminando Basura Electrónica ---\n"
-            header_info += f"De: {mail_data['from']}\n"
-            header_info += f"Asunto original: {mail_data['subject']}\n"
-            header_info += f"Fecha: {mail_data['date']}\n"
-            header_info += "---------------------------------------------------\n\n"
-            
-            # Agregar cuerpos al contenedor 'alternative'
-            has_body = False
-            
-            if mail_data['body_text']:
-                # Normalizar saltos de línea (evita DOS_BODY_HIGH)
-                body_text_clean = mail_data['body_text'].replace('\r\n', '\n').replace('\r', '\n')
-                text_part = MIMEText(header_info + body_text_clean, 'plain', 'utf-8')
-                msg_alternative.attach(text_part)
-                has_body = True
+        if part.is_multipart():
+            return None
+        
+        codificacion = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        if codificacion in ('base64', 'quoted-printable', '7bit'):
+            return part if part.get_payload() else None
+        
+        # Decodificar nombre (por si tiene caracteres MIME)
+        decoded_name = self.decode_mime_header(filename)
+        payload = part.get_payload(decode=True)
+        if not payload:
+            return None
+        
+        # Crear objeto MIME para reenviar
+        attachment = MIMEBase(part.get_content_maintype(), part.get_content_subtype())
+        attachment.set_payload(payload)
+        encoders.encode_base64(attachment)
+        attachment.add_header('Content-Disposition', 'attachment', filename=decoded_name)
+        return attachment
+
+    def render_forward_message(self, cuenta_config, mail_data, include_attachments=False):
+        """
+        Construye y serializa UNA vez el correo reenviado de una regla.
+        Las cabeceras propias de cada destinatario (To, Message-ID) se añaden
+        después con personalize_message, sin volver a codificar cuerpo ni adjuntos.
+        """
+        msg = MIMEMultipart('mixed') 
+        
+        # ===== CABECERAS CRÍTICAS ANTI-SPAM =====
+        msg['From'] = cuenta_config['smtp_user']
+        # To y Message-ID (1.) se añaden por destinatario en personalize_message
+        
+        # 2. Date (CRÍTICO - elimina ~1.36 puntos de spam)
+        msg['Date'] = formatdate(localtime=True)
+        
+        # 3. Asunto con marca de reenvío
+        msg['Subject'] = f"{self.REENVIO_MARKER}{mail_data['subject']}"
+        
+        # 4. Cabeceras adicionales recomendadas
+        msg['MIME-Version'] = '1.0'
+        msg['X-Mailer'] = 'P.E.R.C.E.B.E. v2.1'
+        
+        # 5. Cabeceras de procedencia (ayudan a la trazabilidad)
+        msg['X-Forwarded-From'] = mail_data['from']
+        msg['X-Original-Date'] = mail_data['date']
+        
+        # ===== CONSTRUCCIÓN DEL CUERPO (MEJORADA) =====
+        # Crear el contenedor 'alternative' para texto/HTML
+        msg_alternative = MIMEMultipart('alternative')
+        
+        # Encabezado de reenvío (versión completa del nombre del programa)
+        header_info = f"\n\n--- Correo reenviado automáticamente por Programa de Envío y Redirección de Correo Eliminando Basura Electrónica ---\n"
+        header_info += f"De: {mail_data['from']}\n"
+        header_info += f"Asunto original: {mail_data['subject']}\n"
+        header_info += f"Fecha: {mail_data['date']}\n"
+        header_info += "---------------------------------------------------\n\n"
+        
+        # Agregar cuerpos al contenedor 'alternative'
+        has_body = False
+        
+        if mail_data['body_text']:
+            # Normalizar saltos de línea (evita DOS_BODY_HIGH)
+            body_text_clean = mail_data['body_text'].replace('\r\n', '\n').replace('\r', '\n')
+            text_part = MIMEText(header_info + body_text_clean, 'plain', 'utf-8')
+            msg_alternative.attach(text_part)
+            has_body = True
+        
+        if mail_data['body_html']:
+            html_header = header_info.replace('\n', '<br>')
+            # Asegurar que el HTML esté bien formado
+            html_body = mail_data['body_html']
+            if not html_body.strip().startswith('<'):
+                html_body = f"<html><body>{html_header}{html_body}</body></html>"
+            else:
+                html_body = html_header + html_body
             
-            if mail_data['body_html']:
-                html_header = header_info.replace('\n', '<br>')
-                # Asegurar que el HTML esté bien formado
-                html_body = mail_data['body_html']
-                if not html_body.strip().startswith('<'):
-                    html_body = f"<html><body>{html_header}{html_body}</body></html>"
-                else:
-                    html_body = html_header + html_body
-                
-                html_part = MIMEText(html_body, 'html', 'utf-8')
-                msg_alternative.attach(html_part)
-                has_body = True
+            html_part = MIMEText(html_body, 'html', 'utf-8')
+            msg_alternative.attach(html_part)
+            has_body = True
 
-            # Si no hay cuerpo, añadir al menos el header
-            if not has_body:
-                text_part = MIMEText(header_info, 'plain', 'utf-8')
-                msg_alternative.attach(text_part)
+        # Si no hay cuerpo, añadir al menos el header
+        if not has_body:
+            text_part = MIMEText(header_info, 'plain', 'utf-8')
+            msg_alternative.attach(text_part)
 
-            # Adjuntar el contenedor 'alternative' al principal 'mixed'
-            msg.attach(msg_alternative)
+        # Adjuntar el contenedor 'alternative' al principal 'mixed'
+        msg.attach(msg_alternative)
+        
+        # Si la regla especifica incluir adjuntos, adjuntarlos al 'mixed'
+        if include_attachments and mail_data.get('attachments'):
+            for attachment in mail_data['attachments']:
+                msg.attach(attachment)
+        
+        # Misma serialización que smtplib.send_message (política del mensaje con CRLF)
+        return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+    
+    def personalize_message(self, cuenta_config, mensaje, destinatario):
+        """Antepone al mensaje ya serializado las cabeceras de un destinatario"""
+        # 1. Message-ID (CRÍTICO - elimina ~4.29 puntos de spam)
+        domain = cuenta_config['smtp_user'].split('@')[-1]
+        random_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+        timestamp = int(time.time())
+        
+        politica = email_policy.compat32.clone(linesep='\r\n')
+        cabeceras = politica.fold_binary('To', destinatario)
+        cabeceras += politica.fold_binary('Message-ID', f"<{random_id}.{timestamp}@{domain}>")
+        return cabeceras + mensaje
+    
+    def acquire_send_slot(self, cuenta_config, destinatario, esperar=True):
+        """
+        Aplica el límite de envíos (token bucket por cuenta y dominio) a un envío.
+        Con esperar=False no bloquea: devuelve los segundos que faltan sin reservar nada,
+        o 0 si el envío ya tiene su hueco.
+        """
+        return self.rate_limiter.acquire(
+            f"{cuenta_config['smtp_user']}@{cuenta_config['smtp_server']}",
+            destinatario.rsplit('@', 1)[-1].lower(),
+            cuenta_config.get('envios_por_minuto', self.config.get('envios_por_minuto', 20)),
+            cuenta_config.get('envios_rafaga', self.config.get('envios_rafaga', 5)),
+            cuenta_config.get('envios_por_minuto_dominio', self.config.get('envios_por_minuto_dominio', 0)),
+            esperar=esperar
+        )
+    
+    def forward_email_single(self, cuenta_config, mail_data, regla, destinatario, include_attachments=False, mensaje=None,
+                             hueco_reservado=False):
+        """
+        Reenvía un correo a UN SOLO destinatario
+        Versión 2.1 - Con manejo de errores de conexión
+        Si se recibe el mensaje ya serializado (render_forward_message) no se reconstruye
+        Con hueco_reservado, el límite de envíos ya se aplicó (acquire_send_slot) y no se espera
+        """
+        try:
+            if mensaje is None:
+                mensaje = self.render_forward_message(cuenta_config, mail_data, include_attachments)
             
-            # Si la regla especifica incluir adjuntos, adjuntarlos al 'mixed'
-            if include_attachments and mail_data.get('attachments'):
-                for attachment in mail_data['attachments']:
-                    msg.attach(attachment)
+            # ===== LIMITACIÓN DE RITMO (token bucket por cuenta y dominio) =====
+            clave_smtp = f"{cuenta_config['smtp_user']}@{cuenta_config['smtp_server']}"
+            dominio = destinatario.rsplit('@', 1)[-1].lower()
+            if not hueco_reservado:
+                espera = self.acquire_send_slot(cuenta_config, destinatario)
+                if espera:
+                    self.log_debug(f"Esperados {espera:.1f}s por el límite de envíos antes de enviar a {destinatario}")
             
             # ===== ENVÍO CON MANEJO MEJORADO =====
-            with smtplib.SMTP(cuenta_config['smtp_server'], cuenta_config['smtp_port'], timeout=30) as server:
-                server.starttls()
-                server.login(cuenta_config['smtp_user'], cuenta_config['smtp_password'])
-                server.send_message(msg)
-            
+            # Sesión autenticada del pool (se reutiliza entre destinatarios y ciclos)
+            with self.metrics.timer('percebe_smtp_envio_segundos', servidor=cuenta_config['smtp_server']):
+                server = self.smtp_pool.acquire(cuenta_config)
+                try:
+                    server.sendmail(cuenta_config['smtp_user'], [destinatario],
+                                    self.personalize_message(cuenta_config, mensaje, destinatario))
+                except Exception:
+                    self.smtp_pool.discard(server)
+                    raise
+            self.smtp_pool.release(cuenta_config, server)
+            self.rate_limiter.record_send(clave_smtp, dominio)
+            if self.smtp_breaker.record_success(SMTPConnectionPool.pool_key(cuenta_config)):
+                self.log_info(f"Servidor SMTP {cuenta_config['smtp_server']} recuperado: circuito cerrado")
+
             self.log_reenvio(mail_data['subject'], regla['nombre'], destinatario)
             return True
             
         except (smtplib.SMTPException, socket.error, OSError, TimeoutError) as e:
             # Errores de red/conexión: estos justifican reintento
             self.log_error(f"Error de conexión al reenviar correo a {destinatario}: {e}")
+            if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                # Un destinatario rechazado no indica que el servidor esté caído
+                self.record_smtp_failure(cuenta_config)
             return False
         except Exception as e:
             # Otros errores: registrar pero no reintentar
             self.log_error(f"Error al reenviar correo a {destinatario}: {e}")
             return False
 
+    def record_smtp_failure(self, cuenta_config):
+        """Anota un fallo de conexión en el cortacircuitos del servidor SMTP de la cuenta"""
+        abierto = self.smtp_breaker.record_failure(
+            SMTPConnectionPool.pool_key(cuenta_config),
+            self.config.get('smtp_circuito_fallos', 5),
+            self.config.get('smtp_circuito_espera', 60),
+            self.REINTENTO_MAX_DELAY
+        )
+        if abierto:
+            self.log_error(f"Circuito abierto para {cuenta_config['smtp_server']}: se aplazan sus envíos hasta una prueba correcta")
+    
     def forward_email(self, cuenta_config, mail_data, regla, include_attachments=False):
         """
         Reenvía un correo según la regla especificada
-        Envía a cada destinatario por separado con delay de 3 segundos entre cada uno
+        Envía a cada destinatario por separado, al ritmo que permita el limitador de envíos
         Versión 2.1 - Añade a cola de reintentos si falla
         """
         destinatarios = regla.get('destinatarios', [])
@@ -471,283 +2563,1072 @@ class PercebeServer:
             self.log_error(f"Regla '{regla['nombre']}' no tiene destinatarios configurados")
             return False
         
-        total_enviados = 0
-        total_errores = 0
+        total_enviados = 0
+        total_errores = 0
+        
+        self.log_debug(f"Iniciando reenvío a {len(destinatarios)} destinatarios")
+        
+        # El mensaje se codifica una sola vez para todos los destinatarios de la regla
+        try:
+            mensaje = self.render_forward_message(cuenta_config, mail_data, include_attachments)
+        except Exception as e:
+            self.log_error(f"Error al construir el correo reenviado: {e}")
+            mensaje = None
+        
+        for i, destinatario in enumerate(destinatarios):
+            self.log_debug(f"Enviando a destinatario {i+1}/{len(destinatarios)}: {destinatario}")
+            
+            permitido, _ = self.smtp_breaker.allow(SMTPConnectionPool.pool_key(cuenta_config))
+            if not permitido:
+                # Servidor SMTP caído: directo a la cola, sin esperar al timeout de conexión
+                total_errores += 1
+                self.log_debug(f"Circuito abierto para {cuenta_config['smtp_server']}, {destinatario} pasa a la cola de reintentos")
+                self.log_event('reenvio', cuenta_config, mail_data, regla, destinatario, resultado='aplazado')
+                self.add_to_retry_queue(cuenta_config, mail_data, regla, destinatario, include_attachments)
+                continue
+            
+            inicio = time.time()
+            enviado = self.forward_email_single(cuenta_config, mail_data, regla, destinatario, include_attachments, mensaje)
+            self.log_event('reenvio', cuenta_config, mail_data, regla, destinatario,
+                           resultado='ok' if enviado else 'error', latencia_ms=round((time.time() - inicio) * 1000))
+            if enviado:
+                total_enviados += 1
+                self.log_info(f"Correo reenviado a {destinatario} - Regla '{regla['nombre']}'")
+            else:
+                total_errores += 1
+                self.log_error(f"Fallo al reenviar a {destinatario}, añadiendo a cola de reintentos")
+                # Añadir a cola de reintentos
+                self.add_to_retry_queue(cuenta_config, mail_data, regla, destinatario, include_attachments)
+        
+        self.log_debug(f"Reenvío completado: {total_enviados} exitosos, {total_errores} errores")
+        
+        # Retornar True si al menos un envío fue exitoso
+        return total_enviados > 0
+    
+    def imap_connect(self, cuenta_config):
+        """Abre una conexión IMAP autenticada con la cuenta"""
+        with self.metrics.timer('percebe_imap_conexion_segundos', cuenta=cuenta_config.get('nombre', '')):
+            mail = imaplib.IMAP4_SSL(cuenta_config['imap_server'], timeout=self.config.get('imap_timeout', 60))
+            mail.login(cuenta_config['imap_user'], cuenta_config['imap_password'])
+        return mail
+    
+    def imap_capabilities(self, mail):
+        """Capacidades del servidor IMAP tras el login (pueden cambiar respecto al saludo)"""
+        try:
+            status, data = mail.capability()
+            if status == 'OK' and data and data[0]:
+                return tuple(data[0].decode(errors='ignore').upper().split())
+        except Exception:
+            pass
+        return mail.capabilities
+    
+    def process_mailbox(self, cuenta_config):
+        """Procesa una cuenta de correo usando su sesión IMAP persistente"""
+        key = self.account_key(cuenta_config)
+        
+        # Si la conexión se cae a mitad, se reintenta una vez con una sesión nueva
+        for intento in (1, 2):
+            try:
+                with self.imap_sessions.session(key, cuenta_config) as mail:
+                    self.process_messages(mail, cuenta_config)
+                return
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if intento == 1:
+                    self.log_debug(f"Conexión IMAP perdida en '{cuenta_config.get('nombre', 'desconocida')}', reconectando: {e}")
+                    continue
+                self.metrics.inc('percebe_imap_errores_total', cuenta=cuenta_config.get('nombre', ''))
+                self.log_error(f"Error procesando buzón '{cuenta_config.get('nombre', 'desconocida')}': {e}")
+            except Exception as e:
+                self.metrics.inc('percebe_imap_errores_total', cuenta=cuenta_config.get('nombre', ''))
+                self.log_error(f"Error procesando buzón '{cuenta_config.get('nombre', 'desconocida')}': {e}")
+                return
+    
+    def load_sync_checkpoints(self):
+        """Carga los puntos de control de sincronización IMAP (UIDVALIDITY + último UID)"""
+        if self.sync_checkpoint_file.exists():
+            try:
+                with open(self.sync_checkpoint_file, 'r', encoding='utf-8') as f:
+                    self.sync_checkpoints = json.load(f)
+            except Exception as e:
+                self.log_error(f"Error al cargar puntos de control IMAP: {e}")
+                self.sync_checkpoints = {}
+        else:
+            self.sync_checkpoints = {}
+    
+    def save_sync_checkpoint(self, key, checkpoint):
+        """Guarda el punto de control de una cuenta (escritura atómica)"""
+        with self.sync_lock:
+            self.sync_checkpoints[key] = checkpoint
+            tmp_file = self.sync_checkpoint_file.with_suffix('.tmp')
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.sync_checkpoints, indent=4, fp=f, ensure_ascii=False)
+                os.replace(tmp_file, self.sync_checkpoint_file)
+                return True
+            except Exception as e:
+                self.log_error(f"Error al guardar punto de control IMAP: {e}")
+                return False
+    
+    def imap_mailbox_status(self, mail, condstore):
+        """
+        UIDVALIDITY, UIDNEXT y (con CONDSTORE) HIGHESTMODSEQ de INBOX sin enviar STATUS,
+        que no debe usarse sobre el buzón seleccionado (RFC 3501). Se toman de las
+        respuestas a SELECT y NOOP: UIDVALIDITY no cambia mientras el buzón sigue
+        seleccionado; UIDNEXT y HIGHESTMODSEQ solo valen una vez (se retiran al
+        leerlas) y, si no hay valores nuevos, no se devuelven y se hace la búsqueda.
+        """
+        estado = {}
+        uidvalidity = [v for v in mail.untagged_responses.get('UIDVALIDITY', []) if v]
+        if uidvalidity:
+            estado['uidvalidity'] = int(uidvalidity[-1])
+        for codigo in ('UIDNEXT', 'HIGHESTMODSEQ') if condstore else ('UIDNEXT',):
+            _, valores = mail.response(codigo)
+            valores = [v for v in valores or [] if v]
+            if valores:
+                try:
+                    estado[codigo.lower()] = int(valores[-1])
+                except ValueError:
+                    pass
+        return estado
+    
+    def drain_mailbox_updates(self, mail):
+        """
+        Retira los avisos EXISTS/RECENT/EXPUNGE que imaplib acumula en untagged_responses
+        (en una sesión persistente crecerían sin límite). Devuelve True si alguno indica
+        que puede haber correo nuevo.
+        """
+        pendiente = False
+        for codigo in ('EXISTS', 'RECENT', 'EXPUNGE'):
+            _, valores = mail.response(codigo)
+            valores = [v for v in valores or [] if v]
+            if codigo == 'EXISTS' and valores:
+                pendiente = True
+            elif codigo == 'RECENT' and any(v != b'0' for v in valores):
+                pendiente = True
+        return pendiente
+    
+    def find_new_uids(self, mail, key):
+        """
+        Devuelve (uids nuevos, punto de control, sincronización inicial) desde el último
+        UID procesado. Sin punto de control (o si cambió UIDVALIDITY) se parte de los
+        correos no leídos, como en versiones anteriores. Con CONDSTORE, si HIGHESTMODSEQ
+        no ha cambiado el buzón no tiene novedades y no se busca nada.
+        """
+        condstore = 'CONDSTORE' in self.imap_capabilities(mail)
+        estado = self.imap_mailbox_status(mail, condstore)
+        uidvalidity = estado.get('uidvalidity')
+        uidnext = estado.get('uidnext')
+        
+        with self.sync_lock:
+            checkpoint = dict(self.sync_checkpoints.get(key) or {})
+        
+        if not checkpoint or uidvalidity is None or checkpoint.get('uidvalidity') != uidvalidity:
+            # Primera sincronización: correos no leídos; el resto se considera ya visto
+            status, data = mail.uid('SEARCH', None, 'UNSEEN')
+            if status != 'OK':
+                return [], None, True
+            uids = sorted(int(u) for u in data[0].split())
+            ultimo_uid = uidnext - 1 if uidnext else max(uids, default=0)
+            return uids, {
+                'uidvalidity': uidvalidity,
+                'ultimo_uid': max([ultimo_uid] + uids),
+                'highestmodseq': estado.get('highestmodseq')
+            }, True
+        
+        ultimo_uid = checkpoint.get('ultimo_uid', 0)
+        checkpoint['highestmodseq'] = estado.get('highestmodseq')
+        
+        # Comprobación en tiempo constante: nada nuevo desde el último ciclo
+        if condstore and estado.get('highestmodseq') is not None and estado['highestmodseq'] == self.sync_checkpoints.get(key, {}).get('highestmodseq'):
+            return [], None, False
+        if uidnext is not None and uidnext <= ultimo_uid + 1:
+            return [], checkpoint, False
         
-        self.log_debug(f"Iniciando reenvío a {len(destinatarios)} destinatarios con delay de {self.DELAY_ENTRE_ENVIOS}s")
+        status, data = mail.uid('SEARCH', None, f'UID {ultimo_uid + 1}:*')
+        if status != 'OK':
+            return [], None, False
         
-        for i, destinatario in enumerate(destinatarios):
-            self.log_debug(f"Enviando a destinatario {i+1}/{len(destinatarios)}: {destinatario}")
+        # "n:*" siempre incluye el mayor UID aunque sea menor que n
+        uids = sorted(u for u in (int(x) for x in data[0].split()) if u > ultimo_uid)
+        return uids, checkpoint, False
+    
+    def fetch_headers(self, mail, uids):
+        """
+        Descarga solo las cabeceras necesarias (From, Subject, Date, Message-ID) de varios correos
+        con UID FETCH BODY.PEEK, en lotes. Devuelve {uid: Message con las cabeceras}.
+        """
+        cabeceras = {}
+        
+        for i in range(0, len(uids), self.LOTE_CABECERAS):
+            lote = uids[i:i + self.LOTE_CABECERAS]
+            with self.metrics.timer('percebe_imap_descarga_segundos', tipo='cabeceras'):
+                status, data = mail.uid('FETCH', ','.join(str(u) for u in lote), '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)])')
             
-            if self.forward_email_single(cuenta_config, mail_data, regla, destinatario, include_attachments):
-                total_enviados += 1
-                self.log_info(f"Correo reenviado a {destinatario} - Regla '{regla['nombre']}'")
-            else:
-                total_errores += 1
-                self.log_error(f"Fallo al reenviar a {destinatario}, añadiendo a cola de reintentos")
-                # Añadir a cola de reintentos
-                self.add_to_retry_queue(cuenta_config, mail_data, regla, destinatario, include_attachments)
+            if status != 'OK':
+                continue
             
-            # Esperar entre envíos (excepto después del último)
-            if i < len(destinatarios) - 1:
-                self.log_debug(f"Esperando {self.DELAY_ENTRE_ENVIOS} segundos antes del siguiente envío...")
-                time.sleep(self.DELAY_ENTRE_ENVIOS)
+            for uid, contenido in self._parse_uid_fetch(data):
+                cabeceras[uid] = email.message_from_bytes(contenido)
         
-        self.log_debug(f"Reenvío completado: {total_enviados} exitosos, {total_errores} errores")
+        return cabeceras
+    
+    def _parse_uid_fetch(self, data):
+        """
+        Extrae (uid, contenido) de la respuesta de UID FETCH. Cada correo llega como
+        (b'<num> (UID <uid> BODY[...] {n}', b'<contenido>') seguido de b')', aunque
+        algunos servidores envían el UID después del literal.
+        """
+        resultado = []
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple) or len(item) < 2:
+                continue
+            match = re.search(rb'UID (\d+)', item[0])
+            if match is None and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+                match = re.search(rb'UID (\d+)', data[i + 1])
+            if match is not None:
+                resultado.append((int(match.group(1)), item[1]))
+        return resultado
+    
+    def fetch_raw_message(self, mail, uid):
+        """Descarga un correo completo (bytes RFC822)"""
+        with self.metrics.timer('percebe_imap_descarga_segundos', tipo='completo'):
+            status, msg_data = mail.uid('FETCH', str(uid), '(UID RFC822)')
         
-        # Retornar True si al menos un envío fue exitoso
-        return total_enviados > 0
+        if status != 'OK':
+            return None
+        
+        for _, raw_email in self._parse_uid_fetch(msg_data):
+            return raw_email
+        return None
     
-    def process_mailbox(self, cuenta_config):
-        """Procesa una cuenta de correo"""
+    def fetch_message_size(self, mail, uid):
+        """Tamaño del correo en bytes (RFC822.SIZE) o None si el servidor no lo indica"""
+        status, data = mail.uid('FETCH', str(uid), '(UID RFC822.SIZE)')
+        if status != 'OK':
+            return None
+        for item in data:
+            linea = item[0] if isinstance(item, tuple) else item
+            if isinstance(linea, bytes):
+                match = re.search(rb'RFC822\.SIZE (\d+)', linea)
+                if match:
+                    return int(match.group(1))
+        return None
+    
+    def fetch_message_chunked(self, mail, uid, tamano):
+        """
+        Descarga un correo grande por partes (BODY.PEEK[]<inicio.longitud>) a un
+        archivo temporal del almacén, sin tenerlo nunca entero en memoria.
+        Al terminar lo marca como leído, igual que la descarga completa.
+        Devuelve la ruta del archivo o None si la descarga falla.
+        """
+        ruta = self.spool.temp_path()
+        inicio = 0
+        completo = False
         try:
-            # Conectar a IMAP
-            mail = imaplib.IMAP4_SSL(cuenta_config['imap_server'])
-            mail.login(cuenta_config['imap_user'], cuenta_config['imap_password'])
-            mail.select('INBOX')
-            
-            # Buscar todos los correos no leídos
-            status, messages = mail.search(None, 'UNSEEN')
-            
-            if status != 'OK':
-                return
-            
-            mail_ids = messages[0].split()
-            
-            for mail_id in mail_ids:
-                try:
-                    # Obtener correo
-                    status, msg_data = mail.fetch(mail_id, '(RFC822)')
-                    
+            with open(ruta, 'wb') as f:
+                while inicio < tamano:
+                    status, data = mail.uid('FETCH', str(uid), f'(UID BODY.PEEK[]<{inicio}.{self.TAMANO_PARTE}>)')
                     if status != 'OK':
-                        continue
-                    
-                    # Parsear correo
-                    raw_email = msg_data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-                    
-                    # Extraer información
-                    mail_data = {
-                        'from': self.decode_mime_header(msg.get('From', '')),
-                        'subject': self.decode_mime_header(msg.get('Subject', '')),
-                        'date': msg.get('Date', ''),
-                        'body_text': '',
-                        'body_html': '',
-                        'attachments': []
-                    }
-                    
-                    # Log de procesamiento inicial
-                    self.log_debug(f"--- PROCESANDO CORREO ---")
-                    self.log_debug(f"De: {mail_data['from']}")
-                    self.log_debug(f"Asunto: {mail_data['subject']}")
-                    self.log_debug(f"Fecha: {mail_data['date']}")
+                        self.log_error(f"FETCH parcial rechazado para el correo {uid} ({status})")
+                        return None
+                    partes = self._parse_uid_fetch(data)
+                    trozo = partes[0][1] if partes else b''
+                    if not trozo:
+                        break
+                    f.write(trozo)
+                    inicio += len(trozo)
+                    if len(trozo) < self.TAMANO_PARTE:
+                        break
+            # BODY.PEEK no marca el correo como leído; FETCH RFC822 sí lo hace
+            mail.uid('STORE', str(uid), '+FLAGS.SILENT', '(\\Seen)')
+            completo = True
+        finally:
+            if not completo:
+                ruta.unlink(missing_ok=True)
+        
+        self.log_debug(f"Correo {uid} descargado por partes ({inicio} bytes)")
+        return ruta
+    
+    def parse_message_file(self, ruta):
+        """Parsea un correo desde disco alimentando el parser por bloques"""
+        parser = BytesFeedParser()
+        with open(ruta, 'rb') as f:
+            for trozo in iter(lambda: f.read(self.TAMANO_PARTE), b''):
+                parser.feed(trozo)
+        return parser.close()
+    
+    def fetch_full_message(self, mail, uid):
+        """
+        Descarga un correo completo. Por encima de descarga_por_partes_umbral se
+        descarga por partes a disco. Devuelve (Message, origen), donde origen son los
+        bytes del correo o la ruta del archivo temporal; (None, None) si falla.
+        """
+        umbral = self.config.get('descarga_por_partes_umbral', 10 * 1024 * 1024)
+        tamano = self.fetch_message_size(mail, uid) if umbral else None
+        
+        if tamano is not None and tamano > umbral:
+            with self.metrics.timer('percebe_imap_descarga_segundos', tipo='partes'):
+                ruta = self.fetch_message_chunked(mail, uid, tamano)
+            if ruta is None:
+                return None, None
+            try:
+                with self.metrics.timer('percebe_parseo_segundos', fase='mensaje'):
+                    return self.parse_message_file(ruta), ruta
+            except Exception:
+                ruta.unlink(missing_ok=True)
+                raise
+        
+        raw_email = self.fetch_raw_message(mail, uid)
+        if raw_email is None:
+            return None, None
+        with self.metrics.timer('percebe_parseo_segundos', fase='mensaje'):
+            return email.message_from_bytes(raw_email), raw_email
+    
+    def process_messages(self, mail, cuenta_config):
+        """Procesa los correos nuevos (por UID) de una conexión IMAP con INBOX ya seleccionado"""
+        key = self.account_key(cuenta_config)
+        
+        # Los avisos recibidos hasta ahora quedan cubiertos por esta pasada
+        self.drain_mailbox_updates(mail)
+        
+        # Sincronización incremental: solo los UIDs posteriores al punto de control
+        mail_ids, checkpoint, inicial = self.find_new_uids(mail, key)
+        
+        if not mail_ids:
+            if checkpoint is not None and checkpoint != self.sync_checkpoints.get(key):
+                self.save_sync_checkpoint(key, checkpoint)
+            return
+        
+        self.log_debug(f"{len(mail_ids)} correos nuevos en '{cuenta_config.get('nombre', 'sin nombre')}'")
+        
+        # Reglas activas de la cuenta, compiladas una vez por cambio de configuración
+        rule_index = self.get_rule_index(cuenta_config)
+        debug = self.config.get('logs_completos', False)
+        
+        # Fase 1: solo cabeceras; el correo completo se descarga únicamente si alguna regla coincide
+        cabeceras_primero = self.config.get('descarga_cabeceras_primero', True)
+        cabeceras = self.fetch_headers(mail, mail_ids) if cabeceras_primero and mail_ids else {}
+        
+        for mail_id in mail_ids:
+            avanzar = True
+            origen = None  # bytes del correo o archivo temporal de una descarga por partes
+            self.metrics.inc('percebe_correos_total', cuenta=cuenta_config.get('nombre', ''))
+            try:
+                msg = None
+                headers = cabeceras.get(mail_id)
+                
+                if headers is None:
+                    # Modo clásico (o cabeceras no recibidas): descargar el correo completo
+                    msg, origen = self.fetch_full_message(mail, mail_id)
+                    if msg is None:
+                        # No avanzar el punto de control: se reintentará en el próximo ciclo
+                        avanzar = False
+                        break
+                    headers = msg
+                
+                # Extraer información
+                mail_data = {
+                    'from': self.decode_mime_header(headers.get('From', '')),
+                    'subject': self.decode_mime_header(headers.get('Subject', '')),
+                    'date': headers.get('Date', ''),
+                    'message_id': str(headers.get('Message-ID', '')).strip(),
+                    'body_text': '',
+                    'body_html': '',
+                    'attachments': []
+                }
+                
+                # Log de procesamiento inicial
+                self.log_debug(f"--- PROCESANDO CORREO ---")
+                self.log_debug(f"De: {mail_data['from']}")
+                self.log_debug(f"Asunto: {mail_data['subject']}")
+                self.log_debug(f"Fecha: {mail_data['date']}")
+                
+                # COMPROBAR BUCLE DE REENVÍO ANTES DE CUALQUIER PROCESAMIENTO
+                if self.is_autoforward_loop(mail_data['subject']):
+                    self.log_debug(f"Correo descartado por bucle de autorrespuesta")
+                    self.log_event('bucle', cuenta_config, mail_data, resultado='descartado')
+                    # Eliminar correo del servidor
+                    mail.uid('STORE', str(mail_id), '+FLAGS', '(\\Deleted)')
+                    self.log_debug(f"Correo marcado para eliminación")
+                    self.log_debug(f"--- FIN PROCESAMIENTO ---\n")
+                    continue  # Pasar al siguiente correo
+                
+                # Verificar reglas - Aplicar TODAS las que coincidan (en una sola pasada)
+                reglas_coincidentes = self.match_rules(rule_index, mail_data)
+                
+                if debug:
+                    self.log_debug(f"Evaluadas {len(rule_index.reglas)} reglas activas")
+                    for regla in reglas_coincidentes:
+                        self.log_debug(f"Regla '{regla.get('nombre')}': COINCIDE con el correo")
+                
+                reglas_aplicadas = 0
+                if reglas_coincidentes:
+                    # Fase 2: cuerpo y adjuntos solo para correos que se van a reenviar
+                    if msg is None:
+                        msg, origen = self.fetch_full_message(mail, mail_id)
+                        if msg is None:
+                            avanzar = False
+                            break
                     
-                    # COMPROBAR BUCLE DE REENVÍO ANTES DE CUALQUIER PROCESAMIENTO
-                    if self.is_autoforward_loop(mail_data['subject']):
-                        self.log_debug(f"Correo descartado por bucle de autorrespuesta")
-                        # Eliminar correo del servidor
-                        mail.store(mail_id, '+FLAGS', '\\Deleted')
-                        self.log_debug(f"Correo marcado para eliminación")
-                        self.log_debug(f"--- FIN PROCESAMIENTO ---\n")
-                        continue  # Pasar al siguiente correo
+                    # Original al almacén: los reintentos lo referencian por hash
+                    try:
+                        if isinstance(origen, bytes):
+                            mail_data['spool'] = self.spool.put(origen)
+                        else:
+                            mail_data['spool'] = self.spool.put_file(origen)
+                    except OSError as e:
+                        self.log_error(f"No se pudo guardar el correo en el almacén: {e}")
+                    origen = None
                     
-                    # Obtener cuerpo (solo si no es bucle)
-                    mail_data['body_text'], mail_data['body_html'], mail_data['attachments'] = self.get_email_body(msg)
+                    # Los adjuntos solo se preparan si alguna de las reglas los reenvía
+                    con_adjuntos = any(regla.get('incluir_adjuntos', False) for regla in reglas_coincidentes)
+                    with self.metrics.timer('percebe_parseo_segundos', fase='cuerpo'):
+                        mail_data['body_text'], mail_data['body_html'], mail_data['attachments'] = self.get_email_body(msg, con_adjuntos)
                     self.log_debug(f"Adjuntos detectados: {len(mail_data['attachments'])}")
                     
-                    # Verificar reglas - Aplicar TODAS las que coincidan
-                    reglas_activas = [r for r in cuenta_config.get('reglas', []) if r.get('activa', True)]
-                    
-                    self.log_debug(f"Evaluando {len(reglas_activas)} reglas activas")
-                    
-                    reglas_aplicadas = 0
-                    for regla in reglas_activas:
-                        self.log_debug(f"Evaluando regla: '{regla.get('nombre', 'sin nombre')}'")
+                    for regla in reglas_coincidentes:
+                        # Aplicar regla
+                        include_attachments = regla.get('incluir_adjuntos', False)
                         
-                        if self.check_rule_match(mail_data, regla):
-                            # Aplicar regla
-                            include_attachments = regla.get('incluir_adjuntos', False)
-                            
-                            self.log_debug(f"Aplicando regla '{regla['nombre']}' (adjuntos: {include_attachments})")
-                            
-                            if self.forward_email(cuenta_config, mail_data, regla, include_attachments):
-                                self.log_info(f"Regla '{regla['nombre']}' aplicada: {mail_data['subject']}")
-                                self.log_debug(f"Correo reenviado exitosamente")
-                                reglas_aplicadas += 1
-                            else:
-                                self.log_debug(f"Error al reenviar correo con regla '{regla['nombre']}'")
-                        # NO USAR BREAK - continuar evaluando el resto de reglas
-                    
-                    if reglas_aplicadas == 0:
-                        self.log_debug(f"Ninguna regla coincidió con este correo")
-                    else:
-                        self.log_debug(f"Total de reglas aplicadas: {reglas_aplicadas}")
-                    
-                    # Eliminar correo del servidor
-                    mail.store(mail_id, '+FLAGS', '\\Deleted')
-                    self.log_debug(f"Correo marcado para eliminación")
-                    self.log_debug(f"--- FIN PROCESAMIENTO ---\n")
-                    
-                except Exception as e:
-                    self.log_error(f"Error procesando correo individual: {e}")
+                        self.log_debug(f"Aplicando regla '{regla['nombre']}' (adjuntos: {include_attachments})")
+                        
+                        if self.forward_email(cuenta_config, mail_data, regla, include_attachments):
+                            self.log_info(f"Regla '{regla['nombre']}' aplicada: {mail_data['subject']}")
+                            self.log_debug(f"Correo reenviado exitosamente")
+                            reglas_aplicadas += 1
+                        else:
+                            self.log_debug(f"Error al reenviar correo con regla '{regla['nombre']}'")
+                
+                if reglas_aplicadas == 0:
+                    self.log_debug(f"Ninguna regla coincidió con este correo")
+                else:
+                    self.log_debug(f"Total de reglas aplicadas: {reglas_aplicadas}")
+                
+                # Eliminar correo del servidor
+                mail.uid('STORE', str(mail_id), '+FLAGS', '(\\Deleted)')
+                self.log_debug(f"Correo marcado para eliminación")
+                self.log_debug(f"--- FIN PROCESAMIENTO ---\n")
+                
+            except (imaplib.IMAP4.abort, OSError):
+                # Conexión caída: ni este correo ni los siguientes se han procesado. El punto
+                # de control no avanza y process_mailbox reintenta con una sesión nueva.
+                avanzar = False
+                raise
             
-            # Expunge para eliminar permanentemente
-            mail.expunge()
-            mail.close()
-            mail.logout()
+            except Exception as e:
+                self.log_error(f"Error procesando correo individual: {e}")
             
-        except Exception as e:
-            self.log_error(f"Error procesando buzón '{cuenta_config.get('nombre', 'desconocida')}': {e}")
-    
-    def run_check_cycle(self):
-        """Ejecuta un ciclo de revisión de todas las cuentas"""
-        self.log_info("Iniciando ciclo de revisión de correos")
+            finally:
+                # Descarga por partes de un correo que no se ha llegado a guardar en el almacén
+                if isinstance(origen, Path):
+                    origen.unlink(missing_ok=True)
+                
+                # Avanzar el punto de control tras cada correo (un error de procesamiento no lo repite en bucle).
+                # En la sincronización inicial se guarda al final: si se interrumpe, se repite por UNSEEN.
+                if avanzar and not inicial:
+                    checkpoint['ultimo_uid'] = max(checkpoint.get('ultimo_uid', 0), mail_id)
+                    self.save_sync_checkpoint(key, dict(checkpoint))
         
-        # Primero procesar la cola de reintentos
-        self.process_retry_queue()
+        if inicial and avanzar:
+            self.save_sync_checkpoint(key, checkpoint)
         
-        # Luego revisar nuevos correos
+        # Expunge para eliminar permanentemente
+        mail.expunge()
+    
+    def account_key(self, cuenta_config):
+        """Identificador estable de una cuenta (usuario@servidor IMAP)"""
+        return f"{cuenta_config.get('imap_user', '')}@{cuenta_config.get('imap_server', '')}"
+    
+    def find_account(self, key):
+        """Busca en la configuración actual la cuenta con el identificador indicado"""
+        for cuenta in self.config.get('cuentas', []):
+            if self.account_key(cuenta) == key:
+                return cuenta
+        return None
+    
+    def is_idle_managed(self, cuenta_config):
+        """Indica si la cuenta la atiende un hilo IDLE (y no el sondeo del ciclo)"""
+        with self.idle_lock:
+            return self.account_key(cuenta_config) in self.idle_watchers
+    
+    def sync_idle_watchers(self):
+        """Arranca o detiene los hilos IDLE según la configuración actual"""
+        deseadas = {}
         for cuenta in self.config.get('cuentas', []):
-            if cuenta.get('activa', True):
-                self.log_info(f"Revisando cuenta: {cuenta.get('nombre', 'sin nombre')}")
-                self.process_mailbox(cuenta)
+            if cuenta.get('activa', True) and cuenta.get('modo_idle', False):
+                deseadas[self.account_key(cuenta)] = cuenta
         
-        self.log_info("Ciclo de revisión completado")
+        with self.idle_lock:
+            # Detener los hilos de cuentas que ya no usan IDLE
+            for key, stop_event in list(self.idle_watchers.items()):
+                if key not in deseadas:
+                    stop_event.set()
+            
+            # Olvidar cuentas sin soporte IDLE que ya no lo piden (por si se reconfiguran)
+            self.idle_no_soportado &= set(deseadas)
+            
+            for key, cuenta in deseadas.items():
+                if key in self.idle_watchers or key in self.idle_no_soportado:
+                    continue
+                stop_event = threading.Event()
+                self.idle_watchers[key] = stop_event
+                watcher = threading.Thread(target=self.idle_watch_account, args=(key, stop_event), name=f"idle-{key}")
+                watcher.daemon = True
+                watcher.start()
     
-    def start_api_server(self):
-        """Inicia el servidor API para comunicación con el cliente Windows"""
-        def handle_client(client_socket):
-            try:
-                # Recibir datos en chunks para evitar truncamiento con configs grandes
-                chunks = []
-                client_socket.settimeout(5)  # Timeout de 5 segundos (más robusto)
+    def idle_watch_account(self, key, stop_event):
+        """
+        Mantiene una conexión IMAP abierta en modo IDLE para una cuenta.
+        Procesa el buzón al recibir EXISTS y reemite IDLE antes del timeout del servidor.
+        Si el servidor no soporta IDLE, la cuenta vuelve al sondeo periódico.
+        """
+        espera_reconexion = 5
+        
+        try:
+            while self.running and not stop_event.is_set():
+                cuenta = self.find_account(key)
+                if cuenta is None or not cuenta.get('activa', True) or not cuenta.get('modo_idle', False):
+                    break
                 
-                while True:
-                    try:
-                        chunk = client_socket.recv(4096)
-                        if not chunk:
+                nombre = cuenta.get('nombre', 'sin nombre')
+                try:
+                    # La conexión del hilo IDLE es la sesión persistente de la cuenta
+                    with self.imap_sessions.session(key, cuenta) as mail:
+                        if 'IDLE' not in self.imap_capabilities(mail):
+                            self.log_info(f"El servidor de '{nombre}' no soporta IDLE: se revisará por sondeo periódico")
+                            with self.idle_lock:
+                                self.idle_no_soportado.add(key)
                             break
-                        chunks.append(chunk)
                         
-                        # Si el chunk es menor que 4096, probablemente sea el último
-                        if len(chunk) < 4096:
-                            break
-                    except socket.timeout:
-                        # Si llevamos datos y hay timeout, asumimos que terminó
-                        if chunks:
-                            break
-                        raise
+                        self.log_info(f"Cuenta '{nombre}' en modo IDLE")
+                        espera_reconexion = 5
+                        
+                        while self.running and not stop_event.is_set():
+                            self.process_messages(mail, cuenta)
+                            
+                            # Un EXISTS llegado durante la pasada no se repetirá en IDLE: otra pasada
+                            if self.drain_mailbox_updates(mail):
+                                continue
+                            
+                            self.imap_sessions.set_state(key, 'idle')
+                            if self.imap_idle_wait(mail, self.IDLE_REFRESCO, stop_event):
+                                self.log_debug(f"IDLE: correo nuevo en '{nombre}'")
+                            self.imap_sessions.set_state(key, 'en_uso')
+                            
+                            # Recoger cambios de configuración de la cuenta
+                            cuenta = self.find_account(key)
+                            if cuenta is None or not cuenta.get('activa', True) or not cuenta.get('modo_idle', False):
+                                break
                 
-                request = b''.join(chunks).decode('utf-8')
-                data = json.loads(request)
+                except Exception as e:
+                    self.log_error(f"Error en modo IDLE de la cuenta '{nombre}': {e}")
+                    stop_event.wait(espera_reconexion)
+                    espera_reconexion = min(espera_reconexion * 2, 300)
+        finally:
+            with self.idle_lock:
+                if self.idle_watchers.get(key) is stop_event:
+                    del self.idle_watchers[key]
+    
+    def imap_idle_wait(self, mail, timeout, stop_event):
+        """
+        Emite IDLE (RFC 2177) y espera a que el servidor notifique EXISTS,
+        a que pase el timeout o a que se pida parar. Devuelve True si hay correo nuevo.
+        Lee directamente del socket para poder comprobar stop_event cada segundo.
+        """
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        
+        sock = mail.sock
+        timeout_original = sock.gettimeout()
+        sock.settimeout(1.0)
+        
+        buffer = b''
+        aceptado = False
+        terminado = False
+        nuevos = False
+        inicio = time.time()
+        
+        try:
+            while True:
+                # Procesar las líneas completas recibidas
+                while b'\r\n' in buffer:
+                    line, buffer = buffer.split(b'\r\n', 1)
+                    if line.startswith(b'+'):
+                        aceptado = True
+                    elif line.startswith(tag):
+                        if not line[len(tag):].strip().upper().startswith(b'OK'):
+                            raise imaplib.IMAP4.error(f"IDLE rechazado: {line.decode(errors='ignore')}")
+                        return nuevos
+                    elif line.upper().startswith(b'* BYE'):
+                        raise imaplib.IMAP4.abort(f"Conexión cerrada por el servidor: {line.decode(errors='ignore')}")
+                    elif line.startswith(b'* ') and line.upper().endswith(b' EXISTS'):
+                        nuevos = True
                 
-                command = data.get('command')
-                response = {'status': 'error', 'message': 'Comando desconocido'}
+                # Terminar IDLE al llegar correo, al agotar el tiempo o al parar
+                if aceptado and not terminado:
+                    if nuevos or time.time() - inicio >= timeout or stop_event.is_set() or not self.running:
+                        mail.send(b'DONE\r\n')
+                        terminado = True
+                        inicio_done = time.time()
                 
-                if command == 'get_config':
-                    response = {'status': 'ok', 'data': self.config}
+                try:
+                    chunk = sock.recv(4096)
+                except socket.timeout:
+                    if not aceptado and time.time() - inicio > 30:
+                        raise imaplib.IMAP4.abort("El servidor no respondió al comando IDLE")
+                    if terminado and time.time() - inicio_done > 30:
+                        raise imaplib.IMAP4.abort("El servidor no confirmó el fin de IDLE")
+                    continue
                 
-                elif command == 'set_config':
-                    self.config = data.get('config', self.config)
-                    if self.save_config():
+                if not chunk:
+                    raise imaplib.IMAP4.abort("Conexión cerrada durante IDLE")
+                buffer += chunk
+        finally:
+            sock.settimeout(timeout_original)
+    
+    def run_check_cycle(self):
+        """Ejecuta un ciclo de revisión de todas las cuentas"""
+        self.log_info("Iniciando ciclo de revisión de correos")
+        
+        # Las cuentas en modo IDLE las atiende su propio hilo
+        self.sync_idle_watchers()
+        
+        # Cerrar sesiones IMAP de cuentas eliminadas o desactivadas
+        self.imap_sessions.prune({self.account_key(c) for c in self.config.get('cuentas', []) if c.get('activa', True)})
+        
+        # Luego revisar nuevos correos: cada cuenta en su propio worker
+        inicio = time.time()
+        cuentas_activas = [c for c in self.config.get('cuentas', [])
+                           if c.get('activa', True) and not self.is_idle_managed(c)]
+        
+        if cuentas_activas:
+            max_workers = max(1, int(self.config.get('max_cuentas_paralelas', 4)))
+            max_workers = min(max_workers, len(cuentas_activas))
+            self.log_debug(f"Revisando {len(cuentas_activas)} cuentas con {max_workers} workers")
+            
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cuenta") as executor:
+                futures = {executor.submit(self.check_account, cuenta): cuenta for cuenta in cuentas_activas}
+                for future in as_completed(futures):
+                    cuenta = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # Aislamiento por cuenta: un fallo no detiene el resto del ciclo
+                        self.log_error(f"Error en worker de la cuenta '{cuenta.get('nombre', 'desconocida')}': {e}")
+        
+        # Borrar del almacén los correos que ya no están en la cola de reintentos
+        try:
+            borrados = self.spool.gc(self.retry_store.spool_refs())
+            if borrados:
+                self.log_debug(f"Eliminados {borrados} correos del almacén sin reintentos pendientes")
+        except Exception as e:
+            self.log_error(f"Error al limpiar el almacén de correos: {e}")
+        
+        # Cerrar las sesiones SMTP que llevan demasiado tiempo sin usarse
+        self.smtp_pool.timeout_inactividad = self.config.get('smtp_timeout_inactividad', 300)
+        cerradas = self.smtp_pool.close_idle()
+        if cerradas:
+            self.log_debug(f"Cerradas {cerradas} sesiones SMTP inactivas")
+        
+        duracion = time.time() - inicio
+        self.metrics.observe('percebe_ciclo_segundos', duracion)
+        self.metrics.set('percebe_ultimo_ciclo_timestamp', round(time.time(), 3))
+        self.log_info(f"Ciclo de revisión completado ({len(cuentas_activas)} cuentas en {duracion:.1f}s)")
+    
+    def collect_metrics(self):
+        """Actualiza los medidores que se calculan al consultar (cola de reintentos)"""
+        total, mas_antiguo = self.retry_store.stats()
+        antiguedad = 0
+        if mas_antiguo:
+            try:
+                antiguedad = max(0, round(time.time() - datetime.fromisoformat(mas_antiguo).timestamp(), 1))
+            except ValueError:
+                pass
+        self.metrics.set('percebe_cola_reintentos', total)
+        self.metrics.set('percebe_cola_reintentos_antiguedad_segundos', antiguedad)
+    
+    def render_metrics(self):
+        """Métricas en formato de texto de Prometheus (endpoint HTTP)"""
+        self.collect_metrics()
+        return self.metrics.render_prometheus()
+    
+    def start_metrics_server(self):
+        """Arranca el endpoint HTTP de métricas en 127.0.0.1 (solo accesible desde la máquina)"""
+        puerto = self.config.get('metricas_puerto', 9555)
+        if not puerto:
+            return
+        try:
+            self.metrics_server = ThreadingHTTPServer(('127.0.0.1', puerto), MetricsRequestHandler)
+        except OSError as e:
+            self.log_error(f"No se pudo abrir el endpoint de métricas en el puerto {puerto}: {e}")
+            return
+        self.metrics_server.render_metrics = self.render_metrics
+        threading.Thread(target=self.metrics_server.serve_forever, name="metricas", daemon=True).start()
+        self.log_info(f"Métricas disponibles en http://127.0.0.1:{puerto}/metrics")
+    
+    @staticmethod
+    def _trace_args(args):
+        """Datos que identifican la llamada en la traza (nunca contraseñas ni cuerpos)"""
+        datos = {}
+        for arg in args:
+            if isinstance(arg, dict):
+                if 'imap_user' in arg:
+                    datos['cuenta'] = arg.get('nombre', '')
+                elif 'destinatarios' in arg:
+                    datos['regla'] = arg.get('nombre', '')
+                elif 'subject' in arg:
+                    datos['asunto'] = str(arg['subject'])[:100]
+            elif isinstance(arg, str) and '@' in arg:
+                datos['destinatario'] = arg
+            elif isinstance(arg, int) and not isinstance(arg, bool):
+                datos['id'] = arg
+            elif isinstance(arg, list):
+                datos['n'] = len(arg)
+        return datos
+    
+    def _traced(self, nombre, metodo):
+        """Envoltura de un método que registra cada llamada como tramo de la traza"""
+        tracer = self.tracer
+        
+        @functools.wraps(metodo)
+        def envoltura(*args, **kwargs):
+            with tracer.span(nombre, self._trace_args(args)):
+                resultado = metodo(*args, **kwargs)
+            if nombre == 'run_check_cycle' and tracer.cycle_finished():
+                self.stop_tracing()
+            return resultado
+        return envoltura
+    
+    def start_tracing(self, data):
+        """
+        Activa las trazas (comando start_trace) durante 'ciclos' ciclos de revisión
+        y/o 'segundos' segundos (por defecto, un ciclo). 'perfil' añade cProfile y
+        'memoria' una instantánea de tracemalloc al terminar.
+        """
+        ciclos = data.get('ciclos')
+        segundos = data.get('segundos')
+        if ciclos is None and segundos is None:
+            ciclos = 1
+        try:
+            ciclos = None if ciclos is None else int(ciclos)
+            segundos = None if segundos is None else float(segundos)
+        except (TypeError, ValueError):
+            return {'status': 'error', 'message': "'ciclos' y 'segundos' deben ser números"}
+        if (ciclos is not None and ciclos <= 0) or (segundos is not None and segundos <= 0):
+            return {'status': 'error', 'message': "'ciclos' y 'segundos' deben ser positivos"}
+        
+        with self.trace_lock:
+            if self.tracer.activo:
+                return {'status': 'error', 'message': 'Ya hay una traza en curso'}
+            self.tracer.start(ciclos, bool(data.get('perfil', False)), bool(data.get('memoria', False)))
+            # Solo mientras dura la traza: las instancias ocultan los métodos de la clase
+            for nombre in self.TRAZA_METODOS:
+                setattr(self, nombre, self._traced(nombre, getattr(self, nombre)))
+            if segundos:
+                self.trace_timer = threading.Timer(segundos, self.stop_tracing)
+                self.trace_timer.daemon = True
+                self.trace_timer.start()
+        
+        limite = ' y '.join(filter(None, [f"{ciclos} ciclos" if ciclos else '', f"{segundos:g}s" if segundos else '']))
+        self.log_info(f"Traza activada ({limite})")
+        return {'status': 'ok', 'message': f'Traza activada ({limite})'}
+    
+    def stop_tracing(self):
+        """Termina la traza en curso y la guarda en traza.json (y el perfil en traza.prof)"""
+        with self.trace_lock:
+            if not self.tracer.activo:
+                return False
+            for nombre in self.TRAZA_METODOS:
+                self.__dict__.pop(nombre, None)
+            if self.trace_timer:
+                self.trace_timer.cancel()
+                self.trace_timer = None
+            self.tracer.stop()
+            resultado = self.tracer.result()
+            perfil = self.tracer.perfil
+        
+        try:
+            with open(self.trace_file, 'w', encoding='utf-8') as f:
+                json.dump(resultado['traza'], f, ensure_ascii=False)
+            if perfil is not None:
+                perfil.dump_stats(str(self.profile_file))
+        except Exception as e:
+            self.log_error(f"Error al guardar la traza: {e}")
+        self.log_info(f"Traza terminada: {len(self.tracer.eventos)} tramos en {self.trace_file}")
+        return True
+    
+    def check_account(self, cuenta):
+        """Revisa una cuenta (se ejecuta en un worker del ciclo)"""
+        self.log_info(f"Revisando cuenta: {cuenta.get('nombre', 'sin nombre')}")
+        self.process_mailbox(cuenta)
+    
+    def handle_api_command(self, data):
+        """Ejecuta un comando de la API y devuelve la respuesta (se llama desde el pool de la API)"""
+        command = data.get('command')
+        response = {'status': 'error', 'message': 'Comando desconocido'}
+        
+        if command == 'get_config':
+            # Con 'etag' solo se envía la configuración si ha cambiado desde esa versión
+            with self.config_lock:
+                config, version, etag = self.config, self.config_version, self.config_etag
+            if data.get('etag') == etag:
+                response = {'status': 'ok', 'no_modificado': True, 'version': version, 'etag': etag}
+            else:
+                response = {'status': 'ok', 'data': config, 'version': version, 'etag': etag}
+        
+        elif command == 'set_config':
+            with self.config_lock:
+                response = self.config_conflict(data)
+                if response is None:
+                    if self.publish_config(data.get('config', self.config)):
                         response = {'status': 'ok', 'message': 'Configuración guardada'}
                     else:
                         response = {'status': 'error', 'message': 'Error al guardar'}
-                
-                elif command == 'get_logs':
-                    log_type = data.get('log_type', 'reenvios')
-                    
-                    if log_type == 'reenvios':
-                        log_file = self.log_file
-                    elif log_type == 'errores':
-                        log_file = self.error_log_file
-                    elif log_type == 'procesamiento':
-                        log_file = self.debug_log_file
-                    else:
-                        log_file = self.log_file
-                    
-                    if log_file.exists():
-                        with open(log_file, 'r', encoding='utf-8') as f:
-                            logs = f.readlines()
-                        response = {'status': 'ok', 'data': logs}
-                    else:
-                        response = {'status': 'ok', 'data': []}
-                
-                elif command == 'get_retry_queue':
-                    # Nuevo comando para ver la cola de reintentos
-                    queue_info = []
-                    for item in self.retry_queue:
-                        queue_info.append({
-                            'asunto': item['mail_data']['subject'],
-                            'destinatario': item['destinatario'],
-                            'intentos': item['intentos'],
-                            'proximo_intento': datetime.fromtimestamp(item['proximo_intento']).isoformat(),
-                            'timestamp_creacion': item['timestamp_creacion']
-                        })
-                    response = {'status': 'ok', 'data': queue_info}
-                
-                elif command == 'test_connection':
-                    cuenta_id = data.get('cuenta_id')
-                    if cuenta_id is not None and cuenta_id < len(self.config.get('cuentas', [])):
-                        cuenta = self.config['cuentas'][cuenta_id]
-                        try:
-                            mail = imaplib.IMAP4_SSL(cuenta['imap_server'])
-                            mail.login(cuenta['imap_user'], cuenta['imap_password'])
-                            mail.logout()
-                            response = {'status': 'ok', 'message': 'Conexión exitosa'}
-                        except Exception as e:
-                            response = {'status': 'error', 'message': str(e)}
-                
-                # Enviar respuesta (también en chunks si es grande)
-                response_json = json.dumps(response).encode('utf-8')
-                client_socket.sendall(response_json)
-                
-            except Exception as e:
-                error_response = {'status': 'error', 'message': str(e)}
+                    response.update(version=self.config_version, etag=self.config_etag)
+        
+        elif command == 'patch_config':
+            response = self.patch_config(data)
+        
+        elif command == 'get_logs':
+            log_type = data.get('log_type', 'reenvios')
+        
+            response = self.read_logs(self.log_files().get(log_type, self.log_file), data)
+        
+        elif command == 'get_retry_queue':
+            # Nuevo comando para ver la cola de reintentos
+            queue_info = []
+            for item in self.retry_store.summary():
+                queue_info.append({
+                    'asunto': item['asunto'],
+                    'destinatario': item['destinatario'],
+                    'intentos': item['intentos'],
+                    'proximo_intento': datetime.fromtimestamp(item['proximo_intento']).isoformat(),
+                    'timestamp_creacion': item['timestamp_creacion']
+                })
+            response = {'status': 'ok', 'data': queue_info, 'circuitos': self.smtp_breaker.get_state()}
+        
+        elif command == 'test_connection':
+            cuenta_id = data.get('cuenta_id')
+            if cuenta_id is not None and cuenta_id < len(self.config.get('cuentas', [])):
+                cuenta = self.config['cuentas'][cuenta_id]
                 try:
-                    client_socket.sendall(json.dumps(error_response).encode('utf-8'))
-                except:
-                    pass
+                    # Se prueba (y deja lista) la sesión persistente de la cuenta
+                    with self.imap_sessions.session(self.account_key(cuenta), cuenta, espera=5) as mail:
+                        mail.noop()
+                    response = {'status': 'ok', 'message': 'Conexión exitosa'}
+                except SesionOcupadaError:
+                    response = {'status': 'ok', 'message': 'Conexión activa (sesión en uso)'}
+                except Exception as e:
+                    response = {'status': 'error', 'message': str(e)}
+        
+        elif command == 'get_send_rates':
+            response = {'status': 'ok', 'data': self.rate_limiter.get_rates()}
+        
+        elif command == 'query_events':
+            response = self.query_events(data)
+        
+        elif command == 'get_imap_sessions':
+            response = {'status': 'ok', 'data': self.imap_sessions.get_state()}
+        
+        elif command == 'get_metrics':
+            self.collect_metrics()
+            response = {'status': 'ok', 'data': self.metrics.snapshot()}
+        
+        elif command == 'start_trace':
+            response = self.start_tracing(data)
+        
+        elif command == 'stop_trace':
+            if self.stop_tracing():
+                response = {'status': 'ok', 'message': 'Traza terminada'}
+            else:
+                response = {'status': 'error', 'message': 'No hay ninguna traza en curso'}
+        
+        elif command == 'get_trace':
+            # Traza de la sesión en curso o de la última; 'data' se abre en chrome://tracing o Perfetto
+            resultado = self.tracer.result()
+            response = {'status': 'ok', 'activo': self.tracer.activo, 'data': resultado['traza'],
+                        'perfil': resultado['perfil'], 'memoria': resultado['memoria']}
+        
+        return response
+    
+    def start_api_server(self):
+        """Inicia el servidor API para comunicación con el cliente Windows (bucle asyncio en este hilo)"""
+        try:
+            asyncio.run(self.serve_api())
+        except Exception as e:
+            self.log_error(f"Error en servidor API: {e}")
+    
+    async def serve_api(self):
+        """
+        Servidor API asyncio: las conexiones las atiende el bucle de eventos y los
+        comandos se ejecutan en un pool acotado de hilos (api_workers), con un
+        máximo de api_max_conexiones conexiones simultáneas.
+        """
+        self.api_writers = set()  # conexiones abiertas
+        self.api_executor = ThreadPoolExecutor(max_workers=max(1, int(self.config.get('api_workers', 8))),
+                                               thread_name_prefix="api")
+        puerto = self.config.get('api_port', self.api_port)
+        server = await asyncio.start_server(self.handle_api_connection, '0.0.0.0', puerto)
+        
+        self.log_info(f"Servidor API iniciado en puerto {puerto}")
+        
+        try:
+            while self.running:
+                await asyncio.sleep(1)
+        finally:
+            server.close()
+            # Cerrar las conexiones abiertas para que sus tareas terminen antes que el bucle
+            for writer in list(self.api_writers):
+                writer.close()
+            for _ in range(20):
+                if not self.api_writers:
+                    break
+                await asyncio.sleep(0.1)
+            await server.wait_closed()
+            self.api_executor.shutdown(wait=False, cancel_futures=True)
+    
+    async def handle_api_connection(self, reader, writer):
+        """Atiende una conexión: con tramas (persistente) o con el protocolo antiguo"""
+        self.api_writers.add(writer)
+        try:
+            try:
+                inicio = await asyncio.wait_for(reader.readexactly(len(TRAMA_MAGIA)), self.API_TIMEOUT_PETICION)
+            except asyncio.IncompleteReadError as e:
+                inicio = e.partial  # petición antigua de menos de 4 bytes (o conexión vacía)
+                if not inicio:
+                    return
             
-            finally:
-                try:
-                    client_socket.close()
-                except:
-                    pass
+            con_tramas = inicio == TRAMA_MAGIA
+            if len(self.api_writers) > self.config.get('api_max_conexiones', 32):
+                error = {'status': 'error', 'message': 'Demasiadas conexiones con el servidor'}
+                writer.write(encode_frame(error) if con_tramas else json.dumps(error).encode('utf-8'))
+                await writer.drain()
+                return
+            
+            if con_tramas:
+                await self.serve_framed_connection(reader, writer, inicio)
+            else:
+                await self.serve_legacy_connection(reader, writer, inicio)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.log_error(f"Error en conexión de la API: {e}")
+        finally:
+            self.api_writers.discard(writer)
+            writer.close()
+    
+    async def run_api_command(self, data):
+        """Ejecuta un comando en el pool de la API sin bloquear el bucle de eventos"""
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(self.api_executor, self.handle_api_command, data)
+        except Exception as e:
+            response = {'status': 'error', 'message': str(e)}
+        if 'id' in data:
+            # Permite al cliente emparejar respuestas en conexiones persistentes
+            response = {**response, 'id': data['id']}
+        return response
+    
+    async def serve_framed_connection(self, reader, writer, inicio):
+        """
+        Protocolo con tramas: varias peticiones por conexión, cada una con su
+        respuesta. `hello` devuelve la versión del protocolo y los límites, y
+        negocia la compresión: solo se comprime hacia clientes que la anuncian
+        (o que ya han enviado alguna trama comprimida).
+        """
+        comprimir = False
         
-        # Servidor TCP
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(('0.0.0.0', self.config.get('api_port', self.api_port)))
-        server.listen(5)
+        def codificar(mensajes, umbral):
+            return b''.join(encode_frame(mensaje, comprimir_desde=umbral) for mensaje in mensajes)
         
-        self.log_info(f"Servidor API iniciado en puerto {self.config.get('api_port', self.api_port)}")
+        async def enviar(mensajes):
+            umbral = self.config.get('api_compresion_umbral', 1024) if comprimir else 0
+            if umbral:
+                # Comprimir respuestas grandes fuera del bucle para no frenar otras conexiones
+                datos = await asyncio.get_running_loop().run_in_executor(None, codificar, mensajes, umbral)
+            else:
+                datos = codificar(mensajes, 0)
+            writer.write(datos)
+            await asyncio.wait_for(writer.drain(), self.LOG_SEGUIMIENTO_LATIDO)
         
         while self.running:
             try:
-                server.settimeout(1.0)
-                client_socket, address = server.accept()
-                client_thread = threading.Thread(target=handle_client, args=(client_socket,))
-                client_thread.daemon = True
-                client_thread.start()
-            except socket.timeout:
+                data, flags = await asyncio.wait_for(read_frame(reader, inicio), self.API_TIMEOUT_INACTIVIDAD)
+            except TramaInvalidaError as e:
+                await enviar([{'status': 'error', 'message': str(e)}])
+                return
+            except ValueError as e:
+                # JSON no válido: la trama se ha leído entera, la conexión sigue siendo usable
+                inicio = b''
+                await enviar([{'status': 'error', 'message': f"Petición no válida: {e}"}])
                 continue
-            except Exception as e:
-                self.log_error(f"Error en servidor API: {e}")
+            inicio = b''
+            if flags & TRAMA_ZLIB:
+                comprimir = True
+            
+            if data.get('command') == 'hello':
+                comprimir = 'zlib' in (data.get('compresion') or [])
+                response = {'status': 'ok', 'version': TRAMA_VERSION, 'trama_max': TRAMA_MAX,
+                            'compresion': 'zlib' if comprimir else None}
+                if 'id' in data:
+                    response['id'] = data['id']
+                await enviar([response])
+            elif data.get('command') == 'follow_logs':
+                # Ocupa la conexión hasta que el cliente la cierra
+                await self.follow_logs(data, enviar, reader)
+                return
+            else:
+                await enviar([await self.run_api_command(data)])
+    
+    async def serve_legacy_connection(self, reader, writer, inicio):
+        """
+        Protocolo antiguo: un JSON por conexión. La petición termina cuando el JSON
+        recibido está completo (no al llegar un bloque de menos de 4096 bytes).
+        """
+        buffer = bytearray(inicio)
+        limite = time.monotonic() + self.API_TIMEOUT_PETICION
+        while True:
+            if buffer.rstrip().endswith(b'}'):
+                try:
+                    data = json.loads(buffer.decode('utf-8'))
+                    break
+                except ValueError:
+                    pass
+            restante = limite - time.monotonic()
+            if restante <= 0 or len(buffer) > TRAMA_MAX:
+                raise asyncio.TimeoutError()
+            chunk = await asyncio.wait_for(reader.read(65536), restante)
+            if not chunk:
+                data = json.loads(buffer.decode('utf-8'))
+                break
+            buffer.extend(chunk)
+        
+        async def enviar(mensajes):
+            writer.write(b''.join(json.dumps(mensaje, ensure_ascii=False).encode('utf-8') + b'\n' for mensaje in mensajes))
+            await asyncio.wait_for(writer.drain(), self.LOG_SEGUIMIENTO_LATIDO)
         
-        server.close()
+        if data.get('command') == 'follow_logs':
+            await self.follow_logs(data, enviar, reader)
+            return
+        
+        writer.write(json.dumps(await self.run_api_command(data)).encode('utf-8'))
+        await writer.drain()
     
     def start(self):
         """Inicia el servidor P.E.R.C.E.B.E."""
         self.running = True
         self.log_info("P.E.R.C.E.B.E. v2.1 iniciado")
         
+        # Los reintentos los atiende su propio hilo, en paralelo a la revisión de cuentas
+        self.retry_scheduler.start()
+        
         # Iniciar servidor API en hilo separado
         if self.config.get('api_enabled', True):
             api_thread = threading.Thread(target=self.start_api_server)
             api_thread.daemon = True
             api_thread.start()
         
+        self.start_metrics_server()
+        
         # Bucle principal
         try:
             while self.running:
@@ -760,6 +3641,16 @@ class PercebeServer:
             self.log_error(f"Error crítico: {e}")
         finally:
             self.running = False
+            self.stop_tracing()
+            if self.metrics_server:
+                self.metrics_server.shutdown()
+                self.metrics_server.server_close()
+            self.retry_scheduler.stop(timeout=60)
+            self.smtp_pool.close_all()
+            self.imap_sessions.close_all()
+            self.retry_store.close()
+            self.log_writer.close()  # escribe antes los eventos que queden en cola
+            self.event_log.close()
     
     def stop(self):
         """Detiene el servidor"""
@@ -769,6 +3660,8 @@ class PercebeServer:
 def main():
     """Función principal"""
     server = PercebeServer()
+    # systemd detiene el servicio con SIGTERM: salir por el finally de start() para vaciar logs y colas
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     server.start()
 
 